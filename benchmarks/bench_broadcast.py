@@ -0,0 +1,114 @@
+# Đo /broadcast với Bot API giả và kiểm tra việc tiếp tục sau khi khởi động lại: lượt chạy
+# đầu dừng bot giữa chừng, lượt sau phải gửi nốt từ mốc đã ghi trong DB.
+#
+#   python benchmarks/bench_broadcast.py --users 5000 --stop-after 2000
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ADMIN_ID = 1
+BLOCKED_EVERY = 20
+
+
+def is_blocked(chat_id: int) -> bool:
+    return chat_id != ADMIN_ID and chat_id % BLOCKED_EVERY == 0
+
+
+async def run_bot(args):
+    # Một lần chạy bot trong tiến trình con; ghi danh sách chat đã nhận tin ra --result
+    import bot
+    from telegram import Update
+    from fake_telegram import FakeRequest, message_update
+
+    fake = FakeRequest(latency=args.api_latency, blocked_by=is_blocked)
+    app = bot.build_application(request=fake, get_updates_request=FakeRequest())
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    if args.users:
+        def populate():
+            conn = bot.connect_db()
+            with bot.db_transaction(conn):
+                conn.executemany(bot.SQL_INSERT_USER, ((user_id,) for user_id in range(ADMIN_ID + 1, ADMIN_ID + 1 + args.users)))
+        await bot.run_db(populate)
+        await app.update_queue.put(Update.de_json(message_update(1, ADMIN_ID, '/broadcast Thông báo bảo trì'), app.bot))
+
+    started = time.perf_counter()
+    while True:
+        await asyncio.sleep(0.05)
+        job = bot.active_broadcast
+        if job is None and time.perf_counter() - started > 1:
+            break
+        if job is not None and args.stop_after and job.processed >= args.stop_after:
+            break
+    elapsed = time.perf_counter() - started
+
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+    delivered = [int(params['chat_id']) for params in fake.calls_to('sendMessage')]
+    with open(args.result, 'w') as f:
+        json.dump({'delivered': delivered, 'elapsed': elapsed}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--stop-after', type=int, default=2000, help='dừng bot sau N người nhận ở lượt đầu (0: không dừng)')
+    parser.add_argument('--send-rate', type=float, default=2000, help='SEND_GLOBAL_RATE khi đo')
+    parser.add_argument('--api-latency', type=float, default=0.005)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.result:
+        asyncio.run(run_bot(args))
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_broadcast_')
+    env = dict(os.environ, DB_PATH=os.path.join(tmp_dir, 'bench.db'),
+               ENCRYPTION_KEY_FILE=os.path.join(tmp_dir, 'secret.key'),
+               ADMIN_USER_ID=str(ADMIN_ID), TELEGRAM_BOT_TOKEN='123456:bench',
+               SEND_GLOBAL_RATE=str(args.send_rate), BROADCAST_REPORT_INTERVAL='1')
+    common = [sys.executable, os.path.abspath(__file__), '--api-latency', str(args.api_latency)]
+
+    runs = []
+    for index, (users, stop_after) in enumerate(((args.users, args.stop_after), (0, 0))):
+        result = os.path.join(tmp_dir, f'run{index}.json')
+        subprocess.run(common + ['--users', str(users), '--stop-after', str(stop_after), '--result', result],
+                       env=env, check=True, stderr=subprocess.DEVNULL)
+        with open(result) as f:
+            runs.append(json.load(f))
+
+    recipients = range(ADMIN_ID + 1, ADMIN_ID + 1 + args.users)
+    expected = {user_id for user_id in recipients if not is_blocked(user_id)}
+    counts = Counter(chat_id for run in runs for chat_id in run['delivered'] if chat_id in expected)
+    missing = expected - set(counts)
+    duplicates = sum(count - 1 for count in counts.values() if count > 1)
+
+    for index, run in enumerate(runs):
+        print(f"Lượt {index + 1}: {len(run['delivered']):>7} tin đã gửi  {run['elapsed']:6.2f}s  "
+              f"{len(run['delivered']) / run['elapsed']:8,.0f} tin/s")
+    print(f"Người nhận: {len(expected)}, thiếu: {len(missing)}, gửi lặp sau khi tiếp tục: {duplicates}")
+
+    conn = sqlite3.connect(env['DB_PATH'])
+    blocked = conn.execute('SELECT COUNT(*) FROM users WHERE blocked_at IS NOT NULL').fetchone()[0]
+    status = conn.execute('SELECT status, sent, blocked, failed FROM broadcasts').fetchone()
+    print(f"Đánh dấu đã chặn bot: {blocked}, trạng thái lượt gửi: {status}")
+    assert not missing, sorted(missing)[:10]
+    assert blocked == args.users - len(expected), blocked
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# So sánh thông lượng click: ghi một lần cho mỗi click và gom lượt click theo chu kỳ.
+#
+#   python benchmarks/bench_clicks.py --users 200 --clicks 20000
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# bot.py đọc cấu hình lúc import, nên đặt DB tạm và biến môi trường trước
+_tmp_dir = tempfile.mkdtemp(prefix='bench_clicks_')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'bench.db')
+os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(_tmp_dir, 'secret.key')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def _add_one_click(user_id: int, interest: float):
+    bot.connect_db().execute(bot.SQL_ADD_CLICKS, (1, interest, user_id))
+
+
+async def run_per_click(user_ids, clicks: int):
+    start = time.perf_counter()
+    for i in range(clicks):
+        await bot.run_db(_add_one_click, user_ids[i % len(user_ids)], 0.5)
+    return time.perf_counter() - start
+
+
+async def run_accumulated(user_ids, clicks: int, max_delay: float, max_batch: int):
+    accumulator = bot.ClickAccumulator(max_delay, max_batch)
+
+    async def flush_loop():
+        while True:
+            await asyncio.sleep(max_delay)
+            await accumulator.flush()
+
+    flusher = asyncio.create_task(flush_loop())
+    start = time.perf_counter()
+    for i in range(clicks):
+        accumulator.add(user_ids[i % len(user_ids)], 0.5)
+        # Nhường event loop như một handler thật sau mỗi update
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    await accumulator.flush()
+    elapsed = time.perf_counter() - start
+    flusher.cancel()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--clicks', type=int, default=20000)
+    parser.add_argument('--max-delay', type=float, default=bot.CLICK_FLUSH_INTERVAL)
+    parser.add_argument('--max-batch', type=int, default=bot.CLICK_FLUSH_BATCH)
+    args = parser.parse_args()
+
+    await bot.run_db(bot.migrate_db)
+    user_ids = list(range(1, args.users + 1))
+    for user_id in user_ids:
+        await bot.run_db(bot._insert_user, user_id)
+
+    per_click = await run_per_click(user_ids, args.clicks)
+    accumulated = await run_accumulated(user_ids, args.clicks, args.max_delay, args.max_batch)
+
+    total = await bot.run_db(lambda: bot.connect_db().execute('SELECT SUM(click_count) FROM users').fetchone()[0])
+    assert total == 2 * args.clicks, total
+
+    print(f"Mỗi click một lần ghi: {args.clicks / per_click:,.0f} click/s ({per_click:.2f}s)")
+    print(f"Gom theo chu kỳ:       {args.clicks / accumulated:,.0f} click/s ({accumulated:.2f}s)")
+    await bot.run_db(bot.close_db)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
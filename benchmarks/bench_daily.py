@@ -0,0 +1,68 @@
+# Đo tác vụ cuối ngày trên một bảng users lớn (mặc định 1 triệu hàng).
+#
+#   python benchmarks/bench_daily.py --users 1000000
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix='bench_daily_')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'bench.db')
+os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(_tmp_dir, 'secret.key')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def populate(users: int, active: float, seed: int):
+    rng = random.Random(seed)
+    conn = bot.connect_db()
+    with bot.db_transaction(conn):
+        rows = []
+        for user_id in range(1, users + 1):
+            clicks = rng.randint(1, 1000) if rng.random() < active else 0
+            deposited = rng.choice((0, 100000, 500000, 1000000))
+            rows.append((user_id, deposited, 0, clicks * deposited * 0.00005, clicks, deposited))
+            if len(rows) == 50000:
+                conn.executemany(
+                    'INSERT INTO users (user_id, deposited_amount, withdrawn_amount, income_today, click_count, balance) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', rows)
+                rows = []
+        if rows:
+            conn.executemany(
+                'INSERT INTO users (user_id, deposited_amount, withdrawn_amount, income_today, click_count, balance) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--active', type=float, default=0.3, help='tỉ lệ người dùng có click trong ngày')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    await bot.run_db(bot.migrate_db)
+    started = time.perf_counter()
+    await bot.run_db(populate, args.users, args.active, args.seed)
+    print(f"Tạo {args.users:,} người dùng: {time.perf_counter() - started:.2f}s")
+
+    started = time.perf_counter()
+    stats = await bot.run_daily_accrual()
+    total = time.perf_counter() - started
+    print(f"Tác vụ cuối ngày: {total:.2f}s")
+    print(f"  ghi lãi:        {stats['interest_rows']:,} hàng, {stats['post_seconds']:.2f}s")
+    print(f"  đặt lại bộ đếm: {stats['reset_rows']:,} hàng, {stats['reset_seconds']:.2f}s")
+
+    remaining = await bot.run_db(lambda: bot.connect_db().execute(
+        'SELECT COUNT(*) FROM users WHERE click_count != 0 OR income_today != 0').fetchone()[0])
+    assert remaining == 0, remaining
+    await bot.run_db(bot.close_db)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+# Đo xuất bảng users (có giải mã PII) và transactions ra file nén, kèm mức bộ nhớ tăng thêm.
+#
+#   python benchmarks/bench_export.py --users 1000000 --format csv
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix='bench_export_')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'bench.db')
+os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(_tmp_dir, 'secret.key')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def populate(users: int):
+    # Mỗi trường dùng chung một bản mã: chi phí giải mã khi xuất vẫn như dữ liệu thật,
+    # còn bước chuẩn bị không phải mã hóa hàng triệu lần
+    account, bank, phone = (bot.encrypt_data(value) for value in ('0123456789', 'Vietcombank', '0900000000'))
+    conn = bot.connect_db()
+    with bot.db_transaction(conn):
+        for start in range(1, users + 1, 50000):
+            conn.executemany(
+                'INSERT INTO users (user_id, account_number, bank_name, phone_number, deposited_amount, '
+                'withdrawn_amount, income_today, click_count, balance) VALUES (?, ?, ?, ?, ?, 0, 0, 0, ?)',
+                ((user_id, account, bank, phone, 100000, 100000) for user_id in range(start, min(start + 50000, users + 1))))
+            conn.executemany(
+                "INSERT INTO transactions (user_id, type, amount, created_at) VALUES (?, 'deposit', 100000, ?)",
+                ((user_id, time.time()) for user_id in range(start, min(start + 50000, users + 1))))
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--format', choices=bot.EXPORT_FORMATS, default='csv')
+    args = parser.parse_args()
+
+    bot.migrate_db()
+    started = time.perf_counter()
+    populate(args.users)
+    print(f"Tạo {args.users:,} người dùng: {time.perf_counter() - started:.2f}s")
+
+    for table in bot.EXPORT_TABLES:
+        path = os.path.join(_tmp_dir, f'{table}.{args.format}.gz')
+        rss_before = max_rss_mb()
+        started = time.perf_counter()
+        count = bot.export_table(table, args.format, path)
+        elapsed = time.perf_counter() - started
+        assert count == args.users, count
+        print(f"{table:<13} {count:,} hàng  {elapsed:6.2f}s  {count / elapsed:10,.0f} hàng/s  "
+              f"{os.path.getsize(path) / 1024 / 1024:7.1f} MB  RSS tối đa +{max_rss_mb() - rss_before:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
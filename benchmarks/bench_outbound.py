@@ -0,0 +1,72 @@
+# Chạy hàng đợi gửi tin với Bot API giả có chèn lỗi 429, kiểm tra mọi tin đều tới nơi,
+# các lần sửa liên tiếp được gộp và tốc độ gửi không vượt giới hạn đã cấu hình.
+#
+#   python benchmarks/bench_outbound.py --chats 50 --messages 5 --flood-every 20
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix='bench_outbound_')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'bench.db')
+os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(_tmp_dir, 'secret.key')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Bot  # noqa: E402
+
+import bot  # noqa: E402
+from fake_telegram import FakeRequest  # noqa: E402
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=5, help='số tin gửi tới mỗi chat')
+    parser.add_argument('--edits', type=int, default=100, help='số lần sửa liên tiếp cùng một tin')
+    parser.add_argument('--flood-every', type=int, default=20, help='cứ N lời gọi thì trả về 429')
+    parser.add_argument('--global-rate', type=float, default=200)
+    parser.add_argument('--chat-interval', type=float, default=0.05)
+    args = parser.parse_args()
+
+    fake = FakeRequest(flood_every=args.flood_every, retry_after=1)
+    fake_bot = Bot(os.environ['TELEGRAM_BOT_TOKEN'], request=fake, get_updates_request=FakeRequest())
+    await fake_bot.initialize()
+
+    limiter = bot.RateLimiter({
+        'send_global': (args.global_rate, 1 / args.global_rate, 'chat'),
+        'send_chat': (1, args.chat_interval, 'chat'),
+    }, 10000)
+    queue = bot.OutboundQueue(limiter, concurrency=8, max_retries=5, backoff_base=0.1)
+    queue.start(fake_bot)
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        for chat_id in range(2, args.chats + 2):
+            queue.send(chat_id, f'user {i}')
+        queue.send(1, f'admin {i}', priority=bot.PRIORITY_ADMIN)
+    for i in range(args.edits):
+        queue.edit(2, 99, f'edit {i}')
+
+    while len(queue):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    await queue.stop()
+
+    sent = fake.calls_to('sendMessage')
+    edits = fake.calls_to('editMessageText')
+    floods = sum(1 for name, _ in fake.calls if name.endswith(':429'))
+    expected = args.messages * (args.chats + 1)
+    assert len(sent) == expected, (len(sent), expected)
+    assert edits and edits[-1]['text'] == f'edit {args.edits - 1}', edits[-1:]
+
+    print(f"Đã gửi {len(sent)}/{expected} tin trong {elapsed:.2f}s ({len(sent) / elapsed:,.0f} tin/s)")
+    print(f"Lỗi 429 đã chèn: {floods}, {args.edits} lần sửa gộp thành {len(edits)} lời gọi")
+    await fake_bot.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+# Đo thông lượng chế độ nhiều tiến trình: chia cùng một tập update tổng hợp cho 1, 2, 4, ...
+# tiến trình xử lý qua ShardRouter (Bot API giả, một file SQLite dùng chung cho mỗi lượt đo).
+#
+#   python benchmarks/bench_sharded.py --workers 1,2,4 --users 1000 --updates 20000
+import argparse
+import functools
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+# Nới giới hạn tốc độ để đo toàn bộ đường xử lý thay vì câu trả lời "vui lòng chờ"
+os.environ.setdefault('RATE_UPDATE_INCOME_INTERVAL', '0.001')
+os.environ.setdefault('RATE_BIG_BUTTON_INTERVAL', '0.001')
+os.environ.setdefault('SEND_GLOBAL_RATE', '100000')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet  # noqa: E402
+from fake_telegram import FakeRequest, callback_update, message_update  # noqa: E402
+
+
+def setup(app):
+    # Chạy trong tiến trình xử lý: báo số update đã xong về tiến trình đo theo chu kỳ
+    import bot
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    done = [0, 0]
+
+    async def mark_done(update, context):
+        done[0] += 1
+
+    async def report(context):
+        if done[0] != done[1]:
+            done[1] = done[0]
+            bot.send_to_shard('intake', ('processed', done[0]))
+
+    app.add_handler(TypeHandler(Update, mark_done), group=100)
+    app.job_queue.run_repeating(report, interval=0.25, first=0.25)
+
+
+def build_workload(users: int, updates: int, seed: int) -> list:
+    rng = random.Random(seed)
+    payloads = [message_update(user_id, user_id, '/start') for user_id in range(2, users + 2)]
+    # update_id không được trùng: bot bỏ qua các update lặp
+    update_id = users + 2
+    while len(payloads) < updates:
+        user_id = rng.randint(2, users + 1)
+        if rng.random() < 0.9:
+            payloads.append(callback_update(update_id, user_id, 'update_income'))
+        else:
+            payloads.append(message_update(update_id, user_id, 'Kiểm tra số dư'))
+        update_id += 1
+    return payloads
+
+
+def measure(workers: int, payloads: list, api_latency: float) -> float:
+    tmp_dir = tempfile.mkdtemp(prefix='bench_sharded_')
+    # Tiến trình con (spawn) đọc cấu hình từ biến môi trường khi import bot
+    os.environ['DB_PATH'] = os.path.join(tmp_dir, 'bench.db')
+    os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(tmp_dir, 'secret.key')
+    # Khóa dùng chung cho mọi tiến trình của lượt đo, không tiến trình nào phải tạo file khóa
+    os.environ['ENCRYPTION_KEY'] = Fernet.generate_key().decode()
+    import bot
+    bot.DB_PATH = os.environ['DB_PATH']
+    bot.migrate_db()
+    bot.close_db()
+
+    processed = {}
+    warmed_up = threading.Event()
+    finished = threading.Event()
+
+    def on_message(sender, message):
+        processed[sender] = message[1]
+        total = sum(processed.values())
+        if total >= workers:
+            warmed_up.set()
+        if total >= workers + len(payloads):
+            finished.set()
+
+    def on_failure():
+        # Một tiến trình xử lý chết: dừng chờ ngay thay vì treo tới hết thời gian
+        warmed_up.set()
+        finished.set()
+
+    router = bot.ShardRouter(workers, functools.partial(FakeRequest, latency=api_latency), setup, on_message,
+                             on_failure)
+    router.start()
+    # Một update cho mỗi tiến trình để chờ chúng khởi động xong trước khi bấm giờ
+    for worker in range(workers):
+        router.route(message_update(0, worker, '/noop'))
+    warmed_up.wait(120)
+    assert warmed_up.is_set() and router.failure is None, router.failure or processed
+
+    started = time.perf_counter()
+    for payload in payloads:
+        router.route(payload)
+    finished.wait(600)
+    elapsed = time.perf_counter() - started
+    router.stop()
+    assert finished.is_set() and router.failure is None, router.failure or processed
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--api-latency', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    payloads = build_workload(args.users, args.updates, args.seed)
+    print(f"{len(payloads)} update, {args.users} người dùng, {os.cpu_count()} CPU")
+    baseline = None
+    for workers in (int(part) for part in args.workers.split(',')):
+        elapsed = measure(workers, payloads, args.api_latency)
+        rate = len(payloads) / elapsed
+        baseline = baseline or rate
+        print(f"  {workers:>2} tiến trình: {elapsed:6.2f}s  {rate:9,.0f} update/s  x{rate / baseline:.2f}")
+
+
+if __name__ == '__main__':
+    main()
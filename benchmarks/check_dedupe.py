@@ -0,0 +1,127 @@
+# Kiểm tra bộ chống lặp update trên file SQLite tạm: lệnh duyệt/từ chối của admin được lưu
+# xuống DB và vẫn bị từ chối khi gửi lại sau khi khởi động lại (nạp lại từ DB), còn click và
+# tin nhắn thường chỉ nằm trong bộ nhớ. Trả mã lỗi nếu có kiểm tra thất bại.
+#
+#   python benchmarks/check_dedupe.py
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+_tmp_dir = tempfile.mkdtemp(prefix='check_dedupe_')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'dedupe.db')
+os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(_tmp_dir, 'secret.key')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:check')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from fake_telegram import callback_update, message_update  # noqa: E402
+
+TTL = 3600
+MAX_SIZE = 1000
+
+
+def fresh_db(name: str):
+    bot.close_db()
+    bot.DB_PATH = os.path.join(_tmp_dir, f'{name}.db')
+    bot.migrate_db()
+    return bot.connect_db()
+
+
+def update(payload: dict):
+    return bot.Update.de_json(payload, None)
+
+
+def resent_callback(update_id: int, payload: dict) -> dict:
+    # Cùng callback query nhưng nằm trong một update khác (update_id mới)
+    return dict(payload, update_id=update_id)
+
+
+def flush(deduper) -> int:
+    # flush() ghi qua run_db nên cần một event loop
+    return asyncio.run(deduper.flush())
+
+
+def reload():
+    # Như lúc khởi động: bộ chống lặp mới, nạp các khóa còn hạn từ DB
+    deduper = bot.UpdateDeduper(TTL, MAX_SIZE)
+    deduper.load(bot._fetch_processed_updates(time.time() - TTL, MAX_SIZE))
+    return deduper
+
+
+def stored_keys(conn) -> set:
+    return {row[0] for row in conn.execute('SELECT key FROM processed_updates')}
+
+
+def check_replay_after_reload():
+    conn = fresh_db('replay')
+    approve = callback_update(10, 1, 'approve_5')
+    deny_page = callback_update(11, 1, 'deny_page:1:9')
+    approve_command = message_update(12, 1, '/approve 6')
+    deny_command = message_update(13, 1, '/deny 7')
+
+    deduper = bot.UpdateDeduper(TTL, MAX_SIZE)
+    for payload in (approve, deny_page, approve_command, deny_command):
+        assert deduper.check(update(payload)), payload
+        assert not deduper.check(update(payload)), payload
+    assert flush(deduper) == 6
+    assert stored_keys(conn) == {'u:10', 'c:10', 'u:11', 'c:11', 'u:12', 'u:13'}, stored_keys(conn)
+    # Không còn gì để ghi thêm
+    assert flush(deduper) == 0
+
+    deduper = reload()
+    for payload in (approve, deny_page, approve_command, deny_command):
+        assert not deduper.check(update(payload)), payload
+    # Callback gửi lại trong update mới vẫn bị chặn theo khóa c:
+    assert not deduper.check(update(resent_callback(20, approve)))
+    assert not deduper.check(update(resent_callback(21, deny_page)))
+    # Update mới thật sự vẫn được nhận
+    assert deduper.check(update(callback_update(22, 1, 'approve_8')))
+
+
+def check_only_decisions_persisted():
+    conn = fresh_db('transient')
+    click = callback_update(30, 2, 'update_income')
+    message = message_update(31, 2, 'Kiểm tra số dư')
+    start = message_update(32, 2, '/start')
+    amount = message_update(33, 2, '100000')
+
+    deduper = bot.UpdateDeduper(TTL, MAX_SIZE)
+    for payload in (click, message, start, amount):
+        assert deduper.check(update(payload)), payload
+        assert not deduper.check(update(payload)), payload
+    assert deduper.unsaved == []
+    assert flush(deduper) == 0
+    assert stored_keys(conn) == set()
+
+    # Sau khi khởi động lại chúng chỉ còn được chặn trong bộ nhớ, không qua DB
+    deduper = reload()
+    assert not deduper.seen
+    for payload in (click, message, start, amount):
+        assert deduper.check(update(payload)), payload
+
+
+CHECKS = (check_replay_after_reload, check_only_decisions_persisted)
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception:
+            failed += 1
+            print(f"❌ {check.__name__}")
+            traceback.print_exc()
+        else:
+            print(f"✅ {check.__name__}")
+    bot.close_db()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# Kiểm tra các đường đi của tiền trên file SQLite tạm: bất biến sổ cái (số dư = tổng bút
+# toán), chuyển khoản nguyên tử và hoàn tác khi lỗi, duyệt hàng loạt, khóa chống lặp của giao
+# dịch chờ duyệt và tác vụ cuối ngày. Trả mã lỗi nếu có kiểm tra thất bại.
+#
+#   python benchmarks/check_ledger.py
+import os
+import sys
+import tempfile
+import traceback
+
+_tmp_dir = tempfile.mkdtemp(prefix='check_ledger_')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'ledger.db')
+os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(_tmp_dir, 'secret.key')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:check')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+NOW = 1_700_000_000.0
+
+
+def fresh_db(name: str):
+    # Mỗi kiểm tra một DB mới đã nâng cấp lược đồ
+    bot.close_db()
+    bot.DB_PATH = os.path.join(_tmp_dir, f'{name}.db')
+    bot.migrate_db()
+    return bot.connect_db()
+
+
+def deposit(conn, user_id: int, amount: float):
+    with bot.db_transaction(conn):
+        assert bot._ledger_deposit(conn, user_id, amount, NOW) == 'ok'
+
+
+def balances(conn) -> dict:
+    return dict(conn.execute('SELECT user_id, balance FROM users'))
+
+
+def assert_ledger_invariant(conn):
+    # Số dư vật chất hóa của mọi người dùng bằng tổng bút toán trong sổ cái
+    mismatched = conn.execute('''
+        SELECT u.user_id, u.balance, COALESCE(SUM(t.amount), 0) AS total
+        FROM users u LEFT JOIN transactions t ON t.user_id = u.user_id
+        GROUP BY u.user_id HAVING ABS(u.balance - total) > 1e-9
+    ''').fetchall()
+    assert not mismatched, mismatched
+
+
+def check_transfer():
+    conn = fresh_db('transfer')
+    deposit(conn, 2, 100)
+    deposit(conn, 3, 10)
+
+    with bot.db_transaction(conn):
+        assert bot._ledger_transfer(conn, 2, 3, 40, NOW) == 'ok'
+    assert balances(conn) == {2: 60, 3: 50}
+
+    with bot.db_transaction(conn):
+        assert bot._ledger_transfer(conn, 2, 3, 1000, NOW) == 'insufficient'
+        assert bot._ledger_transfer(conn, 2, 99, 1, NOW) == 'no_recipient'
+        assert bot._ledger_transfer(conn, 2, None, 1, NOW) == 'no_recipient'
+    assert balances(conn) == {2: 60, 3: 50}
+    assert conn.execute("SELECT COUNT(*) FROM transactions WHERE type = 'transfer'").fetchone()[0] == 2
+    assert_ledger_invariant(conn)
+
+
+def check_transfer_rollback():
+    # Lỗi sau khi đã trừ người gửi: cả transaction phải được hoàn tác
+    conn = fresh_db('rollback')
+    deposit(conn, 2, 100)
+    deposit(conn, 3, 0)
+    credit_user = bot.SQL_CREDIT_USER
+    bot.SQL_CREDIT_USER = 'UPDATE users SET no_such_column = 1 WHERE ? AND ? AND ?'
+    try:
+        with bot.db_transaction(conn):
+            bot._ledger_transfer(conn, 2, 3, 40, NOW)
+        raise AssertionError("chuyển khoản lẽ ra phải lỗi")
+    except bot.sqlite3.OperationalError:
+        pass
+    finally:
+        bot.SQL_CREDIT_USER = credit_user
+    assert balances(conn) == {2: 100, 3: 0}
+    assert conn.execute("SELECT COUNT(*) FROM transactions WHERE type = 'transfer'").fetchone()[0] == 0
+    assert_ledger_invariant(conn)
+
+
+def check_bulk_resolve():
+    conn = fresh_db('resolve')
+    deposit(conn, 2, 50)
+    deposit(conn, 3, 0)
+    requests = [
+        (2, 'deposit', 100, None, 'k1'),
+        (2, 'withdraw', 30, None, 'k2'),
+        (2, 'transfer', 100, 3, 'k3'),
+        (3, 'withdraw', 500, None, 'k4'),
+        (2, 'transfer', 5, 99, 'k5'),
+    ]
+    ids = [bot._insert_pending(user_id, action, amount, recipient_id, 'check', key)
+           for user_id, action, amount, recipient_id, key in requests]
+    assert None not in ids
+
+    results, cached = bot._resolve_pending(None, True)
+    statuses = [result[5] for result in results]
+    assert statuses == ['ok', 'ok', 'ok', 'insufficient', 'no_recipient'], statuses
+    # 50 + 100 - 30 - 100 = 20 cho người gửi, 100 cho người nhận
+    assert balances(conn) == {2: 20, 3: 100}
+    assert set(cached) == {2, 3}
+    assert_ledger_invariant(conn)
+
+    # Duyệt lại (bấm "Duyệt" lần nữa, /approve all) không còn gì để làm
+    assert bot._resolve_pending(ids, True) == ([], {})
+    assert bot._resolve_pending(None, False) == ([], {})
+    final = dict(conn.execute('SELECT id, status FROM pending_transactions'))
+    assert [final[i] for i in ids] == ['approved', 'approved', 'approved', 'insufficient', 'no_recipient'], final
+
+    # Một mã lặp lại nhiều lần, vượt quá một lô 500 mã, chỉ được ghi sổ một lần
+    repeated = bot._insert_pending(3, 'deposit', 100, None, 'check', 'repeat')
+    results, _ = bot._resolve_pending([repeated] * 501, True)
+    assert [result[0] for result in results] == [repeated], results
+    assert balances(conn) == {2: 20, 3: 200}
+    assert_ledger_invariant(conn)
+
+    # Duyệt theo khoảng mã của một trang chỉ chạm các giao dịch còn chờ trong khoảng đó
+    page = [bot._insert_pending(2, 'deposit', 1, None, 'check', f'page{i}') for i in range(3)]
+    results, _ = bot._resolve_pending(None, False, (page[0], page[1]))
+    assert [result[0] for result in results] == page[:2]
+    assert conn.execute("SELECT status FROM pending_transactions WHERE id = ?", (page[2],)).fetchone()[0] == 'pending'
+    assert_ledger_invariant(conn)
+
+
+def check_idempotency_key():
+    conn = fresh_db('idempotency')
+    first = bot._insert_pending(2, 'deposit', 100, None, 'check', '2:10')
+    assert first is not None
+    assert bot._insert_pending(2, 'deposit', 100, None, 'check', '2:10') is None
+    assert bot._insert_pending(2, 'deposit', 100, None, 'check', '2:11') is not None
+    # Giao dịch không có khóa (tạo trước khi có cột) không chặn nhau
+    assert bot._insert_pending(2, 'deposit', 1, None, 'check', None) is not None
+    assert bot._insert_pending(2, 'deposit', 1, None, 'check', None) is not None
+    assert conn.execute("SELECT COUNT(*) FROM pending_transactions WHERE idempotency_key = '2:10'").fetchone()[0] == 1
+
+
+def check_daily_accrual():
+    conn = fresh_db('daily')
+    deposit(conn, 2, 1000)
+    deposit(conn, 3, 0)
+    bot._add_clicks([(10, 0.5, 2), (3, 0.0, 3)])
+    with bot.db_transaction(conn):
+        assert bot._ledger_withdraw(conn, 2, 1000.25, NOW) == 'ok'
+
+    stats = bot._daily_accrual(NOW)
+    assert stats['interest_rows'] == 1 and stats['reset_rows'] == 2, stats
+    assert balances(conn) == {2: 0.25, 3: 0}
+    assert conn.execute('SELECT SUM(income_today), SUM(click_count) FROM users').fetchone() == (0, 0)
+    assert conn.execute("SELECT user_id, amount FROM transactions WHERE type = 'interest'").fetchall() == [(2, 0.5)]
+    assert_ledger_invariant(conn)
+
+    # Chạy lại trong cùng ngày không ghi lãi lần hai
+    stats = bot._daily_accrual(NOW)
+    assert stats['interest_rows'] == 0 and stats['reset_rows'] == 0, stats
+    assert_ledger_invariant(conn)
+
+
+CHECKS = (check_transfer, check_transfer_rollback, check_bulk_resolve, check_idempotency_key, check_daily_accrual)
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception:
+            failed += 1
+            print(f"❌ {check.__name__}")
+            traceback.print_exc()
+        else:
+            print(f"✅ {check.__name__}")
+    bot.close_db()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# Bot API giả cho đo tải cục bộ: thay lớp HTTP của python-telegram-bot, ghi lại mọi lời gọi
+# và trả về kết quả hợp lệ mà không cần kết nối tới Telegram.
+import asyncio
+import itertools
+import json
+import time
+
+from telegram.request import BaseRequest
+
+BOT_USER = {'id': 1000000, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+# Các phương thức trả về một Message
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument'}
+
+
+class FakeRequest(BaseRequest):
+    def __init__(self, latency: float = 0.0, flood_every: int = 0, retry_after: int = 1, blocked_by=None):
+        # latency: độ trễ giả lập mỗi lời gọi; flood_every: cứ N lời gọi gửi tin thì trả về lỗi 429;
+        # blocked_by(chat_id): True nếu người dùng đó đã chặn bot (trả về lỗi 403)
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.blocked_by = blocked_by
+        self.calls = []
+        self._message_ids = itertools.count(1)
+        self._send_count = 0
+        # Như HTTPXRequest: sau shutdown() mọi lời gọi đều lỗi
+        self.closed = False
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        self.closed = False
+
+    async def shutdown(self) -> None:
+        self.closed = True
+
+    def calls_to(self, api_method: str) -> list:
+        return [params for name, params in self.calls if name == api_method]
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.closed:
+            raise RuntimeError('This HTTPXRequest is not initialized!')
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+
+        if api_method == 'getUpdates':
+            # Không có update nào qua polling; ngủ để vòng lặp polling không quay liên tục
+            await asyncio.sleep(0.5)
+            return 200, json.dumps({'ok': True, 'result': []}).encode()
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if api_method in MESSAGE_METHODS and self.blocked_by and self.blocked_by(int(params.get('chat_id', 0))):
+            self.calls.append((api_method + ':403', params))
+            return 403, json.dumps({
+                'ok': False,
+                'error_code': 403,
+                'description': 'Forbidden: bot was blocked by the user',
+            }).encode()
+
+        if api_method in MESSAGE_METHODS:
+            self._send_count += 1
+            if self.flood_every and self._send_count % self.flood_every == 0:
+                self.calls.append((api_method + ':429', params))
+                return 429, json.dumps({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                }).encode()
+
+        self.calls.append((api_method, params))
+        return 200, json.dumps({'ok': True, 'result': self._result(api_method, params)}).encode()
+
+    def _result(self, api_method: str, params: dict):
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method in MESSAGE_METHODS:
+            chat_id = params.get('chat_id', 0)
+            return {
+                'message_id': params.get('message_id') or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        return True
+
+
+def user_payload(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user_payload(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id: int, user_id: int, data: str, chat_id: int = None) -> dict:
+    chat_id = user_id if chat_id is None else chat_id
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': user_payload(user_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': '📆 Click để cập nhật thu nhập!',
+            },
+        },
+    }
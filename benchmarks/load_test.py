@@ -0,0 +1,173 @@
+# Kiểm thử tải ngoại tuyến cho các handler: dựng Update/CallbackQuery tổng hợp, đưa qua
+# Application thật (bộ xử lý update đồng thời, JobQueue, hàng đợi gửi tin) với Bot API giả và
+# một file SQLite tạm, rồi báo cáo thông lượng, độ trễ p50/p95/p99 theo từng loại update và
+# số câu lệnh SQL trên mỗi update.
+#
+#   python benchmarks/load_test.py --users 500 --updates 20000 --concurrency 128
+#   python benchmarks/load_test.py --max-p99 50 --max-queries 3   # trả mã lỗi nếu vượt ngưỡng
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+_tmp_dir = tempfile.mkdtemp(prefix='load_test_')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'bench.db')
+os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(_tmp_dir, 'secret.key')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+if '--realistic-limits' not in sys.argv:
+    # Mặc định nới giới hạn tốc độ để đo toàn bộ đường xử lý thay vì câu trả lời "vui lòng chờ"
+    os.environ.setdefault('RATE_UPDATE_INCOME_INTERVAL', '0.001')
+    os.environ.setdefault('RATE_BIG_BUTTON_INTERVAL', '0.001')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+
+import bot  # noqa: E402
+from fake_telegram import FakeRequest, callback_update, message_update  # noqa: E402
+
+ADMIN_ID = int(os.environ['ADMIN_USER_ID'])
+
+
+def build_mix(users: list, updates: int, rng: random.Random) -> list:
+    # (loại, user_id, payload builder) theo tỉ lệ: 90% click, 4% xem số dư, 3% nạp, 3% chuyển khoản
+    steps = []
+    while len(steps) < updates:
+        user_id = rng.choice(users)
+        roll = rng.random()
+        if roll < 0.90:
+            steps.append(('click', user_id, 'cb', 'update_income'))
+        elif roll < 0.94:
+            steps.append(('balance', user_id, 'msg', 'Kiểm tra số dư'))
+        elif roll < 0.97:
+            steps.append(('deposit_menu', user_id, 'msg', 'Nạp tiền'))
+            steps.append(('deposit_amount', user_id, 'msg', str(rng.choice((10000, 50000, 100000)))))
+        else:
+            recipient_id = rng.choice(users)
+            steps.append(('transfer_menu', user_id, 'msg', 'Chuyển khoản'))
+            steps.append(('transfer_recipient', user_id, 'msg', str(recipient_id)))
+            steps.append(('transfer_amount', user_id, 'msg', str(rng.choice((1000, 5000)))))
+    return steps
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Driver:
+    def __init__(self, app, concurrency: int):
+        self.app = app
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.kinds = {}
+        self.enqueued_at = {}
+        self.latencies = defaultdict(list)
+        self.outstanding = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def mark_done(self, update: Update, context):
+        kind = self.kinds.pop(update.update_id, None)
+        if kind is None:
+            return
+        self.latencies[kind].append((time.perf_counter() - self.enqueued_at.pop(update.update_id)) * 1000)
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self.idle.set()
+        self.semaphore.release()
+
+    async def submit(self, kind: str, user_id: int, form: str, data: str):
+        await self.semaphore.acquire()
+        update_id = next(self.update_ids)
+        payload = message_update(update_id, user_id, data) if form == 'msg' else callback_update(update_id, user_id, data)
+        self.kinds[update_id] = kind
+        self.outstanding += 1
+        self.idle.clear()
+        self.enqueued_at[update_id] = time.perf_counter()
+        await self.app.update_queue.put(Update.de_json(payload, self.app.bot))
+
+    async def run_phase(self, steps: list) -> float:
+        started = time.perf_counter()
+        for step in steps:
+            await self.submit(*step)
+        await self.idle.wait()
+        return time.perf_counter() - started
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=128)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='độ trễ giả lập của mỗi lời gọi Bot API (giây)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--realistic-limits', action='store_true', help='giữ nguyên giới hạn tốc độ click như khi chạy thật')
+    parser.add_argument('--max-p99', type=float, help='ngưỡng p99 (ms) cho mọi loại update')
+    parser.add_argument('--max-queries', type=float, help='ngưỡng số câu lệnh SQL trung bình mỗi update')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    fake = FakeRequest(latency=args.api_latency)
+    app = bot.build_application(request=fake, get_updates_request=FakeRequest())
+    driver = Driver(app, args.concurrency)
+    app.add_handler(TypeHandler(Update, driver.mark_done), group=100)
+
+    query_count = [0]
+
+    def count_query(statement):
+        query_count[0] += 1
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    # Đếm sau post_init để không tính các câu lệnh nâng cấp lược đồ
+    await bot.run_db(lambda: bot.connect_db().set_trace_callback(count_query))
+
+    users = list(range(ADMIN_ID + 1, ADMIN_ID + 1 + args.users))
+    phases = {}
+    phases['start'] = await driver.run_phase([('start', user_id, 'msg', '/start') for user_id in users])
+    phases['mix'] = await driver.run_phase(build_mix(users, args.updates, rng))
+
+    pending_ids = await bot.run_db(lambda: [row[0] for row in bot.connect_db().execute(
+        "SELECT id FROM pending_transactions WHERE status = 'pending' ORDER BY id")])
+    phases['approve'] = await driver.run_phase(
+        [('approve', ADMIN_ID, 'cb', f'approve_transaction:{pending_id}') for pending_id in pending_ids])
+
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+    total_updates = sum(len(samples) for samples in driver.latencies.values())
+    queries_per_update = query_count[0] / total_updates
+    mix_updates = sum(len(driver.latencies[k]) for k in driver.latencies if k not in ('start', 'approve'))
+
+    print(f"{args.users} người dùng, {total_updates} update, đồng thời {args.concurrency}")
+    for name, elapsed in phases.items():
+        count = mix_updates if name == 'mix' else len(driver.latencies[name])
+        print(f"  pha {name:<8} {count:>7} update  {elapsed:6.2f}s  {count / elapsed:10,.0f} update/s")
+    print(f"{'loại':<20}{'số lượng':>9}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)")
+    failed = False
+    for kind, samples in sorted(driver.latencies.items()):
+        p99 = percentile(samples, 99)
+        print(f"{kind:<20}{len(samples):>9}{percentile(samples, 50):>9.1f}{percentile(samples, 95):>9.1f}{p99:>9.1f}")
+        if args.max_p99 is not None and p99 > args.max_p99:
+            failed = True
+    print(f"Câu lệnh SQL: {query_count[0]} ({queries_per_update:.2f} mỗi update), lời gọi Bot API: {len(fake.calls)}")
+
+    if args.max_queries is not None and queries_per_update > args.max_queries:
+        failed = True
+    if failed:
+        print("❌ Vượt ngưỡng đã đặt")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
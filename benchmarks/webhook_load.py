@@ -0,0 +1,141 @@
+# Đo thông lượng và độ trễ của chế độ webhook mà không cần Telegram: chạy bot trong cùng
+# tiến trình với Bot API giả, rồi POST các Update JSON tổng hợp vào cổng webhook cục bộ.
+#
+#   python benchmarks/webhook_load.py --users 200 --updates 5000 --concurrency 64
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+_tmp_dir = tempfile.mkdtemp(prefix='webhook_load_')
+os.environ['DB_PATH'] = os.path.join(_tmp_dir, 'bench.db')
+os.environ['ENCRYPTION_KEY_FILE'] = os.path.join(_tmp_dir, 'secret.key')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+# Nới giới hạn tốc độ để đo toàn bộ đường xử lý click thay vì câu trả lời "vui lòng chờ"
+os.environ.setdefault('RATE_UPDATE_INCOME_INTERVAL', '0.001')
+os.environ.setdefault('RATE_BIG_BUTTON_INTERVAL', '0.001')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+
+import bot  # noqa: E402
+from fake_telegram import FakeRequest, callback_update, message_update  # noqa: E402
+
+SECRET = 'bench-secret'
+
+
+def build_workload(users: int, updates: int, seed: int) -> list:
+    rng = random.Random(seed)
+    payloads = []
+    update_id = 1
+    for user_id in range(2, users + 2):
+        payloads.append(message_update(update_id, user_id, '/start'))
+        update_id += 1
+    while len(payloads) < updates:
+        user_id = rng.randint(2, users + 1)
+        if rng.random() < 0.9:
+            payloads.append(callback_update(update_id, user_id, 'update_income'))
+        else:
+            payloads.append(message_update(update_id, user_id, 'Kiểm tra số dư'))
+        update_id += 1
+    return payloads
+
+
+async def post_worker(port: int, queue: asyncio.Queue, sent_at: dict):
+    # Client HTTP/1.1 keep-alive tối giản để phía gửi không chiếm phần lớn event loop dùng chung
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while not queue.empty():
+            payload = queue.get_nowait()
+            body = json.dumps(payload).encode()
+            head = (
+                f"POST /webhook HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n\r\n"
+            ).encode()
+            sent_at[payload['update_id']] = time.perf_counter()
+            writer.write(head + body)
+            status_line = await reader.readline()
+            if b' 200 ' not in status_line:
+                raise RuntimeError(f"Webhook trả về {status_line!r}")
+            length = 0
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode().partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            if length:
+                await reader.readexactly(length)
+    finally:
+        writer.close()
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--port', type=int, default=18443)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='độ trễ giả lập của mỗi lời gọi Bot API (giây)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    fake = FakeRequest(latency=args.api_latency)
+    app = bot.build_application(request=fake, get_updates_request=FakeRequest())
+
+    sent_at = {}
+    done_at = {}
+    finished = asyncio.Event()
+    payloads = build_workload(args.users, args.updates, args.seed)
+
+    async def mark_done(update: Update, context):
+        done_at[update.update_id] = time.perf_counter()
+        if len(done_at) == len(payloads):
+            finished.set()
+
+    # Nhóm cuối cùng: chạy sau mọi handler của bot cho cùng update
+    app.add_handler(TypeHandler(Update, mark_done), group=100)
+
+    await app.initialize()
+    # run_webhook/run_polling tự gọi post_init/post_stop/post_shutdown; ở đây khởi động thủ công nên gọi trực tiếp
+    await app.post_init(app)
+    await app.updater.start_webhook(listen='127.0.0.1', port=args.port, url_path='webhook', secret_token=SECRET)
+    await app.start()
+
+    queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(post_worker(args.port, queue, sent_at) for _ in range(args.concurrency)))
+    await asyncio.wait_for(finished.wait(), timeout=300)
+    elapsed = time.perf_counter() - start
+
+    await app.updater.stop()
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+    latencies = [(done_at[i] - sent_at[i]) * 1000 for i in done_at]
+    print(f"Updates:     {len(payloads)} ({args.users} người dùng, đồng thời {args.concurrency})")
+    print(f"Thông lượng: {len(payloads) / elapsed:,.0f} update/s")
+    print(f"Độ trễ (ms): p50={percentile(latencies, 50):.1f} p95={percentile(latencies, 95):.1f} "
+          f"p99={percentile(latencies, 99):.1f} trung bình={statistics.mean(latencies):.1f}")
+    print(f"Lời gọi Bot API: {len(fake.calls)}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
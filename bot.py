@@ -1,12 +1,34 @@
+from __future__ import annotations
+
 import time
 import sqlite3
 import logging
 import os
+import asyncio
+import csv
+import gzip
+import heapq
+import json
+import tempfile
+import itertools
+import datetime
+import functools
+import sys
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes
-import base64
-from cryptography.fernet import Fernet
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+# telegram.ext (kéo theo tornado cho webhook) chỉ được import khi dựng Application, để
+# import bot.py trong công cụ và benchmark không phải trả chi phí này
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
+from cryptography.fernet import Fernet, InvalidToken
 
 # Tải biến môi trường từ file .env
 load_dotenv()
@@ -15,193 +37,1892 @@ load_dotenv()
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 
 # Biến toàn cục
-click_count = 0
-income_today = 0
-last_click_time = 0
-last_update_time = 0
 target_clicks = 1000
 admin_user_id = int(os.getenv("ADMIN_USER_ID"))  # ID của admin
-bank_account_info = {
-    'account_number': '',
-    'bank_name': '',
-    'phone_number': '',
-    'deposited_amount': 0,
-    'withdrawn_amount': 0,
+
+# Giờ chạy tác vụ cuối ngày: ghi lãi trong ngày vào sổ cái và đặt lại bộ đếm
+DAILY_RESET_TIME = os.getenv("DAILY_RESET_TIME", "00:00")
+BOT_TIMEZONE = ZoneInfo(os.getenv("BOT_TIMEZONE", "Asia/Ho_Chi_Minh"))
+
+# Chế độ webhook: bật khi có WEBHOOK_URL, ngược lại chạy polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "256"))
+
+# WORKERS > 1: một tiến trình nhận update (polling hoặc webhook) chia update cho WORKERS tiến
+# trình xử lý theo user_id, nên update của một người dùng luôn đi tới cùng một tiến trình theo
+# đúng thứ tự. Các tiến trình dùng chung file SQLite (WAL, busy_timeout).
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Tiến trình xử lý chết sau khi đã chạy ít nhất ngần này giây thì được khởi động lại; chết sớm
+# hơn (lỗi cấu hình, khóa mã hóa, ...) thì cả bot dừng thay vì khởi động lại mãi
+WORKER_RESTART_MIN_UPTIME = float(os.getenv("WORKER_RESTART_MIN_UPTIME", "10"))
+SHARD_INDEX = 0
+SHARD_COUNT = 1
+# Hàng đợi (multiprocessing) tới tiến trình nhận update, dùng để nhắn cho tiến trình khác
+shard_control = None
+
+# Bộ nhớ đệm trạng thái người dùng
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+
+# Hội thoại nhiều bước (nạp, rút, chuyển khoản, cập nhật thông tin) bị bỏ dở quá lâu thì hết hạn
+CONVERSATION_TIMEOUT = float(os.getenv("CONVERSATION_TIMEOUT", "300"))
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+
+# Chống xử lý lặp (webhook gửi lại, polling nhận lại sau khi khởi động lại): update_id và id
+# callback đã nhận được nhớ DEDUPE_TTL giây, tối đa DEDUPE_CACHE_SIZE khóa; riêng các lệnh
+# duyệt/từ chối giao dịch được ghi theo lô xuống bảng processed_updates sau mỗi
+# DEDUPE_FLUSH_INTERVAL giây
+DEDUPE_TTL = float(os.getenv("DEDUPE_TTL", "86400"))
+DEDUPE_CACHE_SIZE = int(os.getenv("DEDUPE_CACHE_SIZE", "100000"))
+DEDUPE_FLUSH_INTERVAL = float(os.getenv("DEDUPE_FLUSH_INTERVAL", "2"))
+PERSISTED_CALLBACK_PREFIXES = ('approve_', 'deny_')
+PERSISTED_COMMANDS = ('/approve', '/deny')
+
+# Gom lượt click: ghi xuống DB tối đa sau CLICK_FLUSH_INTERVAL giây hoặc khi đủ CLICK_FLUSH_BATCH người dùng
+CLICK_FLUSH_INTERVAL = float(os.getenv("CLICK_FLUSH_INTERVAL", "1"))
+CLICK_FLUSH_BATCH = int(os.getenv("CLICK_FLUSH_BATCH", "500"))
+
+# Giới hạn tốc độ theo từng người dùng (hoặc từng chat): hành động -> (số lượt tối đa liên tiếp, số giây nạp lại một lượt, phạm vi)
+RATE_LIMITS = {
+    'big_button': (
+        float(os.getenv("RATE_BIG_BUTTON_BURST", "1")),
+        float(os.getenv("RATE_BIG_BUTTON_INTERVAL", "1.5")),
+        os.getenv("RATE_BIG_BUTTON_SCOPE", "user"),
+    ),
+    'update_income': (
+        float(os.getenv("RATE_UPDATE_INCOME_BURST", "1")),
+        float(os.getenv("RATE_UPDATE_INCOME_INTERVAL", "2")),
+        os.getenv("RATE_UPDATE_INCOME_SCOPE", "user"),
+    ),
 }
+RATE_LIMITER_SIZE = int(os.getenv("RATE_LIMITER_SIZE", "100000"))
+
+# Hàng đợi gửi tin: giới hạn toàn bot và theo từng chat (Telegram cho phép khoảng 30 tin/giây
+# và 1 tin/giây mỗi chat), số lần thử lại và thời gian chờ cơ sở của backoff
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_CHAT_INTERVAL = float(os.getenv("SEND_CHAT_INTERVAL", "1"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "8"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+SEND_BACKOFF_BASE = float(os.getenv("SEND_BACKOFF_BASE", "0.5"))
+
+# Độ ưu tiên gửi: số nhỏ được gửi trước
+PRIORITY_ADMIN = 0
+PRIORITY_USER = 1
+PRIORITY_EDIT = 2
+PRIORITY_BROADCAST = 3
+
+# Gửi tin hàng loạt: đọc người nhận theo lô, giữ tối đa BROADCAST_WINDOW tin chưa có kết quả
+# trong hàng đợi gửi tin và ghi mốc tiến độ xuống DB sau mỗi BROADCAST_CHECKPOINT_INTERVAL giây
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "500"))
+BROADCAST_WINDOW = int(os.getenv("BROADCAST_WINDOW", "100"))
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", "2"))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "10"))
+
+# Xuất dữ liệu cho đối soát: đọc theo lô EXPORT_CHUNK_SIZE hàng, nén gzip vào EXPORT_DIR.
+# Telegram chỉ nhận file bot gửi tới 50 MB; file lớn hơn được giữ lại trên máy chủ.
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "2000"))
+EXPORT_DIR = os.getenv("EXPORT_DIR", tempfile.gettempdir())
+EXPORT_MAX_UPLOAD = 50 * 1024 * 1024
+
+# Đường dẫn cơ sở dữ liệu
+DB_PATH = os.getenv("DB_PATH", "user_data.db")
+
+# Khóa mã hóa: lấy từ ENCRYPTION_KEY, hoặc đọc (tạo ở lần chạy đầu) từ ENCRYPTION_KEY_FILE
+# để dữ liệu đã mã hóa vẫn đọc được sau khi khởi động lại
+ENCRYPTION_KEY_FILE = os.getenv("ENCRYPTION_KEY_FILE", "secret.key")
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS", str(min(4, os.cpu_count() or 1))))
+CRYPTO_CHUNK_SIZE = 256
+# Cho phép tạo khóa mới dù DB đã có bản mã: dữ liệu từ bản cũ (mỗi lần khởi động dùng một khóa
+# ngẫu nhiên) vốn không đọc lại được, các trường đó được coi là rỗng
+ENCRYPTION_KEY_RESET = os.getenv("ENCRYPTION_KEY_RESET") == "1"
+
+def _db_has_ciphertext() -> bool:
+    if not os.path.exists(DB_PATH):
+        return False
+    conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+    try:
+        return conn.execute(
+            "SELECT 1 FROM users WHERE account_number != '' OR bank_name != '' OR phone_number != '' LIMIT 1"
+        ).fetchone() is not None
+    except sqlite3.OperationalError:
+        # Chưa có bảng users
+        return False
+    finally:
+        conn.close()
+
+def load_encryption_key() -> bytes:
+    key = os.getenv("ENCRYPTION_KEY")
+    if key:
+        return key.encode()
+    try:
+        with open(ENCRYPTION_KEY_FILE, 'rb') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        # Khóa mới sẽ khóa ngoài mọi dữ liệu đã mã hóa; thường là do chạy từ thư mục khác
+        if _db_has_ciphertext() and not ENCRYPTION_KEY_RESET:
+            raise RuntimeError(
+                f"Không tìm thấy khóa mã hóa {os.path.abspath(ENCRYPTION_KEY_FILE)} trong khi {DB_PATH} đã có "
+                "dữ liệu mã hóa. Hãy đặt ENCRYPTION_KEY_FILE hoặc ENCRYPTION_KEY trỏ tới khóa cũ, hoặc "
+                "ENCRYPTION_KEY_RESET=1 nếu dữ liệu được tạo bởi bản cũ dùng khóa ngẫu nhiên."
+            )
+        key = Fernet.generate_key()
+        # Ghi đủ vào file tạm (mkstemp: quyền 0600) rồi mới gắn vào tên thật, nên không ai đọc
+        # thấy khóa ghi dở. Dùng link thay vì replace: nhiều tiến trình khởi động cùng lúc thì
+        # chỉ khóa của tiến trình đầu tiên được giữ, các tiến trình còn lại đọc lại khóa đó.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ENCRYPTION_KEY_FILE)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(key)
+                f.flush()
+                os.fsync(f.fileno())
+            os.link(tmp_path, ENCRYPTION_KEY_FILE)
+        except FileExistsError:
+            with open(ENCRYPTION_KEY_FILE, 'rb') as f:
+                return f.read().strip()
+        finally:
+            os.remove(tmp_path)
+        logging.info(f"Đã tạo khóa mã hóa mới tại {ENCRYPTION_KEY_FILE}")
+        return key
+
+# Khóa được nạp ở lần dùng đầu tiên (hoặc khi khởi động bot), không phải lúc import: import
+# bot.py từ công cụ hay benchmark không đọc DB, không tạo file khóa
+cipher_suite = None
+_cipher_lock = threading.Lock()
+
+def get_cipher_suite() -> Fernet:
+    global cipher_suite
+    if cipher_suite is None:
+        # Luồng crypto có thể cùng gọi lần đầu
+        with _cipher_lock:
+            if cipher_suite is None:
+                cipher_suite = Fernet(load_encryption_key())
+    return cipher_suite
+
+# Mã hóa/giải mã chạy trên pool riêng, không chiếm event loop hay luồng DB
+crypto_executor = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix='crypto')
+
+# Các trường thông tin cá nhân được lưu ở dạng mã hóa
+PII_FIELDS = ('account_number', 'bank_name', 'phone_number')
+
+# Số liệu vận hành, xuất theo định dạng văn bản của Prometheus khi có METRICS_PORT
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_REFRESH_INTERVAL = float(os.getenv("METRICS_REFRESH_INTERVAL", "15"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+# Bộ đếm và histogram chỉ là cộng số trên dict nên đủ rẻ để luôn bật; nhãn là tuple (tên, giá trị)
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.help = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name: str, text: str, func):
+        self.describe(name, 'gauge', text)
+        self.gauges[name] = func
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def render(self) -> str:
+        lines = []
+        for name, series in list(self.counters.items()):
+            kind, text = self.help.get(name, ('counter', name))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            lines += [f"{name}{self._labels(labels)} {value}" for labels, value in list(series.items())]
+        for name, series in list(self.histograms.items()):
+            kind, text = self.help.get(name, ('histogram', name))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} histogram"]
+            for labels, histogram in list(series.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for name, func in self.gauges.items():
+            _, text = self.help[name]
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} gauge", f"{name} {func()}"]
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('bot_handler_requests_total', 'counter', 'Số lần gọi handler theo kết quả')
+metrics.describe('bot_handler_latency_seconds', 'histogram', 'Thời gian xử lý của handler')
+metrics.describe('bot_db_query_seconds', 'histogram', 'Thời gian chạy thao tác DB trên luồng DB')
+metrics.describe('bot_user_cache_requests_total', 'counter', 'Lượt tra bộ nhớ đệm trạng thái người dùng')
+metrics.describe('bot_outbound_messages_total', 'counter', 'Tin nhắn gửi ra theo kết quả')
+metrics.describe('bot_duplicate_updates_total', 'counter', 'Update lặp bị bỏ qua')
+
+def instrument_handler(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await callback(update, context)
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            metrics.observe('bot_handler_latency_seconds', (('handler', name),), time.perf_counter() - started)
+            metrics.inc('bot_handler_requests_total', (('handler', name), ('outcome', outcome)))
+    return wrapper
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if request_line.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+metrics_server = None
+
+async def start_metrics_server():
+    global metrics_server
+    if METRICS_PORT:
+        metrics_server = await asyncio.start_server(_serve_metrics, METRICS_LISTEN, METRICS_PORT)
+        logging.info(f"Số liệu vận hành tại http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
 
-# Khóa mã hóa
-encryption_key = base64.urlsafe_b64encode(os.urandom(32))
-cipher_suite = Fernet(encryption_key)
+# Lấy mẫu ngăn xếp của mọi luồng trong một khoảng thời gian, bỏ qua luồng đang chờ rảnh
+IDLE_FRAMES = ('threading.py', 'selectors.py', 'queue.py', 'thread.py')
+PROFILE_TOP_STACKS = 5
+
+def sample_stacks(duration: float, interval: float = 0.005, depth: int = 8):
+    counts = Counter()
+    samples = 0
+    own_ident = threading.get_ident()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident or os.path.basename(frame.f_code.co_filename) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None and len(stack) < depth:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            counts[(names.get(ident, ident), tuple(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+# Toàn bộ truy vấn SQLite chạy trên một luồng riêng để không chặn event loop.
+# Một luồng duy nhất giữ một kết nối lâu dài nên các truy vấn được tuần tự hóa
+# mà không cần khóa.
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+db_conn = None
+
+# Câu lệnh SQL dùng lại: sqlite3 lưu bộ nhớ đệm câu lệnh đã biên dịch theo nội dung
+# chuỗi, nên giữ chúng là hằng số để mọi lần gọi đều dùng lại prepared statement.
+SQL_SELECT_USER = '''
+    SELECT user_id, account_number, bank_name, phone_number,
+           deposited_amount, withdrawn_amount, income_today, click_count
+    FROM users WHERE user_id = ?
+'''
+SQL_INSERT_USER = '''
+    INSERT OR IGNORE INTO users (user_id, deposited_amount, withdrawn_amount, income_today, click_count)
+    VALUES (?, 0, 0, 0, 0)
+'''
+# Ghi trễ chỉ áp dụng cho thông tin cá nhân: click đi qua SQL_ADD_CLICKS, tiền đi qua sổ cái
+SQL_UPSERT_USER = '''
+    INSERT INTO users (user_id, account_number, bank_name, phone_number,
+                       deposited_amount, withdrawn_amount, income_today, click_count)
+    VALUES (?, ?, ?, ?, 0, 0, 0, 0)
+    ON CONFLICT(user_id) DO UPDATE SET
+        account_number = excluded.account_number,
+        bank_name = excluded.bank_name,
+        phone_number = excluded.phone_number
+'''
+# Sổ cái giao dịch: amount mang dấu (+ ghi có, - ghi nợ); users.balance luôn bằng tổng
+# amount của người dùng và được cập nhật trong cùng transaction với bút toán
+TRANSACTION_TYPES = ('deposit', 'withdraw', 'transfer', 'interest')
+TRANSACTION_LABELS = {'deposit': 'Nạp tiền', 'withdraw': 'Rút tiền', 'transfer': 'Chuyển khoản', 'interest': 'Tiền lãi'}
+TRANSACTION_VERBS = {'deposit': 'nạp', 'withdraw': 'rút', 'transfer': 'chuyển khoản'}
+TRANSACTION_PAGE_SIZE = 10
+SQL_SELECT_BALANCE = '''
+    SELECT deposited_amount, withdrawn_amount, balance, income_today
+    FROM users WHERE user_id = ?
+'''
+SQL_INSERT_TRANSACTION = '''
+    INSERT INTO transactions (user_id, type, amount, counterparty_id, created_at)
+    VALUES (?, ?, ?, ?, ?)
+'''
+SQL_CREDIT_USER = '''
+    UPDATE users SET balance = balance + ?, deposited_amount = deposited_amount + ?
+    WHERE user_id = ?
+'''
+# Chỉ trừ khi đủ số dư khả dụng (đã ghi sổ + lãi tích lũy trong ngày), kiểm tra và trừ trong một câu lệnh
+SQL_DEBIT_USER = '''
+    UPDATE users SET balance = balance - ?, deposited_amount = deposited_amount - ?,
+                     withdrawn_amount = withdrawn_amount + ?
+    WHERE user_id = ? AND balance + income_today >= ?
+'''
+# Hàng đợi giao dịch chờ admin duyệt, lưu bền trong DB
+PENDING_PAGE_SIZE = 10
+# Khóa chống lặp là tin nhắn chứa số tiền: cùng một tin chỉ tạo được một giao dịch chờ duyệt
+SQL_INSERT_PENDING = '''
+    INSERT INTO pending_transactions (user_id, action, amount, recipient_id, user_info, created_at, idempotency_key)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (idempotency_key) DO NOTHING
+'''
+SQL_SELECT_PENDING_PAGE = '''
+    SELECT id, user_id, action, amount, recipient_id, user_info FROM pending_transactions
+    WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?
+'''
+SQL_COUNT_PENDING = "SELECT COUNT(*) FROM pending_transactions WHERE status = 'pending'"
+SQL_RESOLVE_PENDING = 'UPDATE pending_transactions SET status = ?, resolved_at = ? WHERE id = ?'
+# Các update đã nhận, dự phòng cho bộ nhớ chống lặp khi khởi động lại
+SQL_INSERT_PROCESSED_UPDATE = 'INSERT OR IGNORE INTO processed_updates (key, seen_at) VALUES (?, ?)'
+SQL_SELECT_PROCESSED_UPDATES = 'SELECT key, seen_at FROM processed_updates WHERE seen_at >= ? ORDER BY seen_at DESC LIMIT ?'
+SQL_PRUNE_PROCESSED_UPDATES = 'DELETE FROM processed_updates WHERE seen_at < ?'
+# Cuối ngày: lãi tích lũy (income_today, cộng dồn từ từng click theo số tiền đã nạp lúc click)
+# được ghi thành bút toán 'interest', cộng vào số dư và bộ đếm trong ngày về 0, toàn bộ bằng SQL theo tập
+SQL_POST_DAILY_INTEREST = '''
+    INSERT INTO transactions (user_id, type, amount, counterparty_id, created_at)
+    SELECT user_id, 'interest', income_today, NULL, ? FROM users WHERE income_today > 0
+'''
+SQL_RESET_DAILY_COUNTERS = '''
+    UPDATE users SET balance = balance + MAX(income_today, 0), income_today = 0, click_count = 0
+    WHERE income_today != 0 OR click_count != 0
+'''
+SQL_COUNT_BROADCAST_RECIPIENTS = 'SELECT COUNT(*) FROM users WHERE blocked_at IS NULL'
+SQL_SELECT_BROADCAST_BATCH = '''
+    SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?
+'''
+SQL_INSERT_BROADCAST = '''
+    INSERT INTO broadcasts (text, total, created_at, updated_at) VALUES (?, ?, ?, ?)
+'''
+SQL_SELECT_RUNNING_BROADCAST = '''
+    SELECT id, text, last_user_id, total, sent, failed, blocked, message_id
+    FROM broadcasts WHERE status = 'running' ORDER BY id LIMIT 1
+'''
+SQL_SAVE_BROADCAST = '''
+    UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ?, status = ?, updated_at = ?
+    WHERE id = ?
+'''
+SQL_MARK_BLOCKED = 'UPDATE users SET blocked_at = ? WHERE user_id = ?'
+SQL_UNBLOCK_USER = 'UPDATE users SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL'
+
+SQL_SELECT_TRANSACTIONS = '''
+    SELECT id, type, amount, counterparty_id, created_at FROM transactions
+    WHERE user_id = ? AND (created_at, id) < (?, ?)
+    ORDER BY created_at DESC, id DESC LIMIT ?
+'''
+SQL_ADD_CLICKS = '''
+    UPDATE users SET click_count = click_count + ?, income_today = income_today + ?
+    WHERE user_id = ?
+'''
 
 # Kết nối cơ sở dữ liệu
 def connect_db():
+    global db_conn
+    if db_conn is None:
+        try:
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=128)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            db_conn = conn
+        except sqlite3.Error as e:
+            logging.error(f"Lỗi kết nối cơ sở dữ liệu: {e}")
+            return None
+    return db_conn
+
+def close_db():
+    global db_conn
+    if db_conn is not None:
+        db_conn.close()
+        db_conn = None
+
+@contextmanager
+def db_transaction(conn):
+    conn.execute('BEGIN IMMEDIATE')
     try:
-        return sqlite3.connect('user_data.db')
-    except sqlite3.Error as e:
-        logging.error(f"Lỗi kết nối cơ sở dữ liệu: {e}")
-        return None
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def _timed_db_call(func, args):
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        metrics.observe('bot_db_query_seconds', (('op', func.__name__),), time.perf_counter() - started)
+
+async def run_db(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, _timed_db_call, func, args)
+
+async def run_crypto(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(crypto_executor, func, *args)
 
-def init_db():
-    with connect_db() as conn:
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    account_number TEXT,
-                    bank_name TEXT,
-                    phone_number TEXT,
-                    deposited_amount REAL,
-                    withdrawn_amount REAL,
-                    income_today REAL,
-                    click_count INTEGER
-                )
-            ''')
-            conn.commit()
+# Lược đồ DB được nâng cấp bằng các bước đánh số, áp dụng đúng một lần khi khởi động.
+# Phiên bản hiện tại lưu trong PRAGMA user_version; thêm bước mới vào cuối MIGRATIONS,
+# không sửa các bước đã phát hành.
+def _migration_create_users(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            account_number TEXT,
+            bank_name TEXT,
+            phone_number TEXT,
+            deposited_amount REAL,
+            withdrawn_amount REAL,
+            income_today REAL,
+            click_count INTEGER
+        )
+    ''')
+
+def _migration_add_ledger(conn):
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL CHECK (type IN {TRANSACTION_TYPES}),
+            amount REAL NOT NULL,
+            counterparty_id INTEGER,
+            created_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_time ON transactions (user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_time ON transactions (created_at)')
+
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+    if 'balance' not in columns:
+        # Dữ liệu cũ chưa có sổ cái: ghi số tiền đã nạp hiện có thành bút toán mở đầu
+        conn.execute('ALTER TABLE users ADD COLUMN balance REAL NOT NULL DEFAULT 0')
+        conn.execute('''
+            INSERT INTO transactions (user_id, type, amount, created_at)
+            SELECT user_id, 'deposit', deposited_amount, ? FROM users WHERE deposited_amount > 0
+        ''', (time.time(),))
+        conn.execute('UPDATE users SET balance = COALESCE(deposited_amount, 0)')
+
+def _migration_add_pending_transactions(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pending_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            amount REAL NOT NULL,
+            recipient_id INTEGER,
+            user_info TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at REAL NOT NULL,
+            resolved_at REAL
+        )
+    ''')
+    # Chỉ mục một phần: duyệt hàng đợi chỉ quét các giao dịch còn chờ
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_open ON pending_transactions (id) WHERE status = 'pending'")
+
+def _migration_add_broadcasts(conn):
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+    if 'blocked_at' not in columns:
+        # Thời điểm người dùng chặn bot; NULL là vẫn nhận được tin
+        conn.execute('ALTER TABLE users ADD COLUMN blocked_at REAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            message_id INTEGER,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+def _migration_add_idempotency(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            key TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_processed_updates_seen ON processed_updates (seen_at)')
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(pending_transactions)')}
+    if 'idempotency_key' not in columns:
+        conn.execute('ALTER TABLE pending_transactions ADD COLUMN idempotency_key TEXT')
+    # Các giao dịch cũ có khóa NULL, không trùng nhau trong chỉ mục UNIQUE
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_idempotency ON pending_transactions (idempotency_key)')
+
+# Các bước đều dùng IF NOT EXISTS để nhận cả DB có từ trước khi đánh số phiên bản (user_version = 0)
+MIGRATIONS = (
+    _migration_create_users,
+    _migration_add_ledger,
+    _migration_add_pending_transactions,
+    _migration_add_broadcasts,
+    _migration_add_idempotency,
+)
+
+def migrate_db() -> int:
+    conn = connect_db()
+    while True:
+        # Đọc phiên bản trong transaction ghi: nhiều tiến trình khởi động cùng lúc chỉ một bên
+        # áp dụng mỗi bước. DDL của SQLite nằm trong transaction nên bước và số phiên bản
+        # được ghi cùng nhau.
+        with db_transaction(conn):
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                return version
+            migration = MIGRATIONS[version]
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+        logging.info(f"Đã nâng cấp lược đồ DB lên phiên bản {version + 1} ({migration.__name__})")
 
 def encrypt_data(data: str) -> str:
-    return cipher_suite.encrypt(data.encode()).decode()
+    return get_cipher_suite().encrypt(data.encode()).decode()
 
 def decrypt_data(data: str) -> str:
-    return cipher_suite.decrypt(data.encode()).decode()
-
-def read_user_data(user_id: int):
-    with connect_db() as conn:
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            user_data = cursor.fetchone()
-            if user_data:
-                return {
-                    'User ID': user_data[0],
-                    'Account Number': decrypt_data(user_data[1]) if user_data[1] else '',
-                    'Bank Name': decrypt_data(user_data[2]) if user_data[2] else '',
-                    'Phone Number': decrypt_data(user_data[3]) if user_data[3] else '',
-                    'Deposited Amount': user_data[4],
-                    'Withdrawn Amount': user_data[5],
-                    'Income Today': user_data[6],
-                    'Click Count': user_data[7]
-                }
+    return get_cipher_suite().decrypt(data.encode()).decode()
+
+def decrypt_pii(data: str):
+    # '' nếu trường trống, None nếu không giải mã được bằng khóa hiện tại
+    if not data:
+        return ''
+    try:
+        return decrypt_data(data)
+    except InvalidToken:
+        return None
+
+def _fetch_user_row(user_id: int):
+    conn = connect_db()
+    if conn:
+        return conn.execute(SQL_SELECT_USER, (user_id,)).fetchone()
     return None
 
-def save_user_data(user_id: int):
-    with connect_db() as conn:
-        if conn:
-            cursor = conn.cursor()
-            user_data = (
-                user_id,
-                encrypt_data(bank_account_info['account_number']),
-                encrypt_data(bank_account_info['bank_name']),
-                encrypt_data(bank_account_info['phone_number']),
-                bank_account_info['deposited_amount'],
-                bank_account_info['withdrawn_amount'],
-                income_today,
-                click_count
-            )
+def _insert_user(user_id: int):
+    conn = connect_db()
+    if conn:
+        conn.execute(SQL_INSERT_USER, (user_id,))
+
+def _add_clicks(rows: list):
+    conn = connect_db()
+    if conn:
+        with db_transaction(conn):
+            conn.executemany(SQL_ADD_CLICKS, rows)
+
+def _save_many_user_data(rows: list):
+    conn = connect_db()
+    if conn:
+        with db_transaction(conn):
+            conn.executemany(SQL_UPSERT_USER, rows)
+
+def _encrypt_rows(rows: list) -> list:
+    # Mỗi trường PII đi kèm bản mã đã lưu; chỉ mã hóa lại trường đã thay đổi
+    encrypted = []
+    for user_id, pii in rows:
+        ciphertexts = tuple((token or encrypt_data(value)) if value else None for value, token in pii)
+        encrypted.append((user_id,) + ciphertexts)
+    return encrypted
+
+def _fetch_balance(user_id: int):
+    return connect_db().execute(SQL_SELECT_BALANCE, (user_id,)).fetchone()
+
+# Các bút toán dưới đây chạy bên trong một transaction đang mở và trả về trạng thái
+def _ledger_deposit(conn, user_id: int, amount: float, now: float) -> str:
+    conn.execute(SQL_INSERT_USER, (user_id,))
+    conn.execute(SQL_CREDIT_USER, (amount, amount, user_id))
+    conn.execute(SQL_INSERT_TRANSACTION, (user_id, 'deposit', amount, None, now))
+    return 'ok'
+
+def _ledger_withdraw(conn, user_id: int, amount: float, now: float) -> str:
+    if conn.execute(SQL_DEBIT_USER, (amount, amount, amount, user_id, amount)).rowcount == 0:
+        return 'insufficient'
+    conn.execute(SQL_INSERT_TRANSACTION, (user_id, 'withdraw', -amount, None, now))
+    return 'ok'
+
+def _ledger_transfer(conn, sender_id: int, recipient_id: int, amount: float, now: float) -> str:
+    # Trừ người gửi, cộng người nhận và ghi hai bút toán trong cùng transaction của bên gọi
+    if recipient_id is None or conn.execute(SQL_SELECT_BALANCE, (recipient_id,)).fetchone() is None:
+        return 'no_recipient'
+    if conn.execute(SQL_DEBIT_USER, (amount, amount, 0, sender_id, amount)).rowcount == 0:
+        return 'insufficient'
+    conn.execute(SQL_CREDIT_USER, (amount, amount, recipient_id))
+    conn.executemany(SQL_INSERT_TRANSACTION, [
+        (sender_id, 'transfer', -amount, recipient_id, now),
+        (recipient_id, 'transfer', amount, sender_id, now),
+    ])
+    return 'ok'
+
+def _insert_pending(user_id: int, action: str, amount: float, recipient_id, user_info: str, idempotency_key: str):
+    # None nếu khóa đã có: giao dịch này đã được ghi nhận từ trước
+    conn = connect_db()
+    cursor = conn.execute(SQL_INSERT_PENDING, (user_id, action, amount, recipient_id, user_info, time.time(), idempotency_key))
+    return cursor.lastrowid if cursor.rowcount else None
+
+def _count_pending():
+    return connect_db().execute(SQL_COUNT_PENDING).fetchone()[0]
+
+def _fetch_pending_page(after_id: int, limit: int):
+    conn = connect_db()
+    return conn.execute(SQL_SELECT_PENDING_PAGE, (after_id, limit)).fetchall(), conn.execute(SQL_COUNT_PENDING).fetchone()[0]
+
+def _resolve_pending(ids: list, approve: bool, id_range: tuple = None):
+    # Duyệt hoặc từ chối cả lô trong một transaction. ids=None nghĩa là mọi giao dịch đang chờ,
+    # hoặc mọi giao dịch đang chờ có mã trong id_range (đầu, cuối) khi có id_range.
+    conn = connect_db()
+    now = time.time()
+    results = []
+    with db_transaction(conn):
+        if id_range is not None:
+            rows = conn.execute(
+                "SELECT id, user_id, action, amount, recipient_id FROM pending_transactions "
+                "WHERE status = 'pending' AND id BETWEEN ? AND ? ORDER BY id",
+                id_range,
+            ).fetchall()
+        elif ids is None:
+            rows = conn.execute(
+                "SELECT id, user_id, action, amount, recipient_id FROM pending_transactions "
+                "WHERE status = 'pending' ORDER BY id"
+            ).fetchall()
+        else:
+            # Mã lặp lại (/approve 5 5 ...) rơi vào các lô khác nhau sẽ bị đọc và ghi sổ hai lần
+            ids = sorted(set(ids))
+            rows = []
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows.extend(conn.execute(
+                    "SELECT id, user_id, action, amount, recipient_id FROM pending_transactions "
+                    f"WHERE status = 'pending' AND id IN ({','.join('?' * len(chunk))}) ORDER BY id",
+                    chunk,
+                ).fetchall())
+
+        for pending_id, user_id, action, amount, recipient_id in rows:
+            if not approve:
+                status = 'denied'
+            elif action == 'deposit':
+                status = _ledger_deposit(conn, user_id, amount, now)
+            elif action == 'withdraw':
+                status = _ledger_withdraw(conn, user_id, amount, now)
+            else:
+                status = _ledger_transfer(conn, user_id, recipient_id, amount, now)
+            conn.execute(SQL_RESOLVE_PENDING, ('approved' if status == 'ok' else status, now, pending_id))
+            results.append((pending_id, user_id, action, amount, recipient_id, status))
+
+    # Số dư mới của những người bị ảnh hưởng, để cập nhật bộ nhớ đệm
+    affected = {r[1] for r in results if r[5] == 'ok'} | {r[4] for r in results if r[5] == 'ok' and r[4]}
+    balances = {user_id: _fetch_balance(user_id) for user_id in affected}
+    return results, balances
+
+def _daily_accrual(now: float) -> dict:
+    conn = connect_db()
+    stats = {}
+    with db_transaction(conn):
+        started = time.perf_counter()
+        stats['interest_rows'] = conn.execute(SQL_POST_DAILY_INTEREST, (now,)).rowcount
+        stats['post_seconds'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        stats['reset_rows'] = conn.execute(SQL_RESET_DAILY_COUNTERS).rowcount
+        stats['reset_seconds'] = time.perf_counter() - started
+    return stats
+
+def _fetch_transactions(user_id: int, before: tuple, limit: int):
+    return connect_db().execute(SQL_SELECT_TRANSACTIONS, (user_id, before[0], before[1], limit)).fetchall()
+
+def _count_broadcast_recipients():
+    return connect_db().execute(SQL_COUNT_BROADCAST_RECIPIENTS).fetchone()[0]
+
+def _insert_broadcast(text: str, total: int, now: float) -> int:
+    return connect_db().execute(SQL_INSERT_BROADCAST, (text, total, now, now)).lastrowid
+
+def _fetch_running_broadcast():
+    return connect_db().execute(SQL_SELECT_RUNNING_BROADCAST).fetchone()
+
+def _fetch_broadcast_batch(after_user_id: int, limit: int) -> list:
+    return [row[0] for row in connect_db().execute(SQL_SELECT_BROADCAST_BATCH, (after_user_id, limit))]
+
+def _set_broadcast_message(broadcast_id: int, message_id: int):
+    connect_db().execute('UPDATE broadcasts SET message_id = ? WHERE id = ?', (message_id, broadcast_id))
+
+def _save_broadcast(progress: tuple, blocked_ids: list, now: float):
+    # Mốc tiến độ và danh sách người dùng đã chặn bot được ghi cùng nhau
+    conn = connect_db()
+    with db_transaction(conn):
+        conn.execute(SQL_SAVE_BROADCAST, progress)
+        conn.executemany(SQL_MARK_BLOCKED, [(now, user_id) for user_id in blocked_ids])
+
+def _unblock_user(user_id: int):
+    connect_db().execute(SQL_UNBLOCK_USER, (user_id,))
+
+def _fetch_processed_updates(since: float, limit: int) -> list:
+    return connect_db().execute(SQL_SELECT_PROCESSED_UPDATES, (since, limit)).fetchall()
+
+def _save_processed_updates(rows: list, expired_before: float):
+    conn = connect_db()
+    with db_transaction(conn):
+        conn.executemany(SQL_INSERT_PROCESSED_UPDATE, rows)
+        conn.execute(SQL_PRUNE_PROCESSED_UPDATES, (expired_before,))
+
+# Bảng xuất -> (câu truy vấn, tên cột, vị trí các cột được mã hóa)
+EXPORT_TABLES = {
+    'users': (
+        '''SELECT user_id, account_number, bank_name, phone_number, deposited_amount,
+                  withdrawn_amount, income_today, click_count, balance FROM users ORDER BY user_id''',
+        ('user_id', 'account_number', 'bank_name', 'phone_number', 'deposited_amount',
+         'withdrawn_amount', 'income_today', 'click_count', 'balance'),
+        (1, 2, 3),
+    ),
+    'transactions': (
+        'SELECT id, user_id, type, amount, counterparty_id, created_at FROM transactions ORDER BY id',
+        ('id', 'user_id', 'type', 'amount', 'counterparty_id', 'created_at'),
+        (),
+    ),
+}
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+def _decrypt_export_chunk(rows: list, encrypted_columns: tuple) -> tuple:
+    # Trả về (các hàng đã giải mã, số trường không giải mã được, xuất ra rỗng)
+    decrypted = []
+    unreadable = 0
+    for row in rows:
+        row = list(row)
+        for i in encrypted_columns:
+            row[i] = decrypt_pii(row[i])
+            if row[i] is None:
+                row[i] = ''
+                unreadable += 1
+        decrypted.append(row)
+    return decrypted, unreadable
+
+def export_table(table: str, fmt: str, path: str) -> int:
+    # Chạy ngoài event loop, trên kết nối chỉ đọc riêng: WAL cho một ảnh chụp nhất quán
+    # trong suốt lần xuất mà không giữ luồng DB của bot. Mỗi lô được giải mã trên
+    # crypto_executor trong khi lô sau đang được đọc; số lô đang xử lý có giới hạn nên bộ
+    # nhớ không phụ thuộc kích thước bảng.
+    query, columns, encrypted_columns = EXPORT_TABLES[table]
+    conn = sqlite3.connect(DB_PATH)
+    count = 0
+    unreadable = 0
+    try:
+        conn.execute('PRAGMA query_only = ON')
+        # File chứa PII đã giải mã: chỉ chủ sở hữu đọc được (kể cả khi ghi đè file cũ), không đi
+        # theo symlink, và bị xóa nếu xuất lỗi giữa chừng
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        try:
+            with open(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8', newline='', compresslevel=5) as out:
+                os.fchmod(raw.fileno(), 0o600)
+                if fmt == 'csv':
+                    writer = csv.writer(out)
+                    writer.writerow(columns)
+                    write_rows = writer.writerows
+                else:
+                    def write_rows(rows):
+                        out.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows)
+
+                cursor = conn.execute(query)
+                in_flight = deque()
+                while True:
+                    rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                    if rows and not encrypted_columns:
+                        write_rows(rows)
+                        count += len(rows)
+                        continue
+                    if rows:
+                        in_flight.append(crypto_executor.submit(_decrypt_export_chunk, rows, encrypted_columns))
+                    while in_flight and (not rows or len(in_flight) > CRYPTO_WORKERS):
+                        chunk, chunk_unreadable = in_flight.popleft().result()
+                        write_rows(chunk)
+                        count += len(chunk)
+                        unreadable += chunk_unreadable
+                    if not rows:
+                        if unreadable:
+                            logging.warning(f"Xuất {table}: {unreadable} trường không giải mã được bằng khóa hiện tại, ghi rỗng")
+                        return count
+        except BaseException:
+            os.remove(path)
+            raise
+    finally:
+        conn.close()
+
+async def read_user_data(user_id: int):
+    row = await run_db(_fetch_user_row, user_id)
+    if row is None:
+        return None
+    return await run_crypto(UserState.from_row, row)
+
+# Trạng thái tài khoản của từng người dùng, giữ trong bộ nhớ và ghi trễ xuống DB
+class UserState:
+    __slots__ = ('user_id', 'account_number', 'bank_name', 'phone_number',
+                 'deposited_amount', 'withdrawn_amount', 'income_today', 'click_count', 'dirty',
+                 'encrypted')
+
+    def __init__(self, user_id: int, account_number: str = '', bank_name: str = '', phone_number: str = '',
+                 deposited_amount: float = 0, withdrawn_amount: float = 0, income_today: float = 0,
+                 click_count: int = 0):
+        self.user_id = user_id
+        self.account_number = account_number
+        self.bank_name = bank_name
+        self.phone_number = phone_number
+        self.deposited_amount = deposited_amount or 0
+        self.withdrawn_amount = withdrawn_amount or 0
+        self.income_today = income_today or 0
+        self.click_count = click_count or 0
+        self.dirty = False
+        # Bản mã tương ứng với từng trường trong PII_FIELDS, None nếu cần mã hóa lại
+        self.encrypted = [None, None, None]
+
+    @classmethod
+    def from_row(cls, row: tuple):
+        # Chạy trên crypto_executor: giải mã một lần khi nạp, sau đó phục vụ từ bộ nhớ
+        pii = [decrypt_pii(ciphertext) for ciphertext in row[1:4]]
+        state = cls(row[0], *(value or '' for value in pii), row[4], row[5], row[6], row[7])
+        state.encrypted = [ciphertext if value is not None else None for ciphertext, value in zip(row[1:4], pii)]
+        unreadable = pii.count(None)
+        if unreadable:
+            # Trường không giải mã được coi là rỗng và được ghi lại bằng khóa hiện tại ở lần flush sau
+            state.dirty = True
+            logging.warning(f"Người dùng {row[0]}: {unreadable} trường không giải mã được bằng khóa hiện tại, coi là rỗng")
+        return state
+
+    def set_pii(self, field: str, value: str):
+        if getattr(self, field) == value:
+            return
+        setattr(self, field, value)
+        self.encrypted[PII_FIELDS.index(field)] = None
+        self.dirty = True
+
+    def as_row(self) -> tuple:
+        pii = tuple((getattr(self, field), self.encrypted[i]) for i, field in enumerate(PII_FIELDS))
+        return (self.user_id, pii)
+
+    def apply_balance(self, balance_row: tuple):
+        self.deposited_amount, self.withdrawn_amount = balance_row[0], balance_row[1]
+
+def shard_of(user_id: int) -> int:
+    return user_id % SHARD_COUNT
+
+def owns_user(user_id: int) -> bool:
+    return shard_of(user_id) == SHARD_INDEX
+
+def is_leader() -> bool:
+    # Tiến trình giữ admin chạy các tác vụ chỉ được chạy một lần: cuối ngày, gửi tin hàng loạt
+    return owns_user(admin_user_id)
+
+def send_to_shard(target, message: tuple):
+    # target: số thứ tự tiến trình hoặc 'others' (mọi tiến trình trừ tiến trình gửi)
+    shard_control.put((SHARD_INDEX, target, message))
+
+# LRU theo user_id; bản ghi bẩn bị đẩy ra được giữ lại cho tới lần flush kế tiếp
+user_cache = OrderedDict()
+evicted_dirty_users = {}
+
+def _cache_user_state(state: UserState):
+    user_cache[state.user_id] = state
+    user_cache.move_to_end(state.user_id)
+    while len(user_cache) > USER_CACHE_SIZE:
+        _, evicted = user_cache.popitem(last=False)
+        if evicted.dirty:
+            evicted_dirty_users[evicted.user_id] = evicted
+
+async def get_user_state(user_id: int, create: bool = False):
+    if not owns_user(user_id):
+        # Người dùng của tiến trình khác (ví dụ người nhận chuyển khoản): đọc thẳng từ DB,
+        # không giữ trong bộ nhớ đệm vì tiến trình này không thấy các thay đổi của họ
+        return await read_user_data(user_id)
+
+    state = user_cache.get(user_id)
+    if state is not None:
+        user_cache.move_to_end(user_id)
+        metrics.inc('bot_user_cache_requests_total', (('result', 'hit'),))
+        return state
+
+    metrics.inc('bot_user_cache_requests_total', (('result', 'miss'),))
+    state = evicted_dirty_users.pop(user_id, None)
+    if state is None:
+        loaded = await read_user_data(user_id)
+        # Một coroutine khác có thể đã nạp người dùng này trong lúc chờ DB
+        state = user_cache.get(user_id) or evicted_dirty_users.pop(user_id, None)
+        if state is None:
+            if loaded is not None:
+                state = loaded
+                # Cộng thêm các lượt click còn nằm trong bộ gom, chưa được ghi xuống DB
+                pending = click_accumulator.pending.get(user_id)
+                if pending:
+                    state.click_count += pending[0]
+                    state.income_today += pending[1]
+            elif create:
+                # Tạo hàng ngay để các lần cộng dồn click sau đó luôn có hàng để cập nhật
+                await run_db(_insert_user, user_id)
+                state = user_cache.get(user_id) or UserState(user_id)
+            else:
+                return None
+    _cache_user_state(state)
+    return state
+
+async def read_balance(user_id: int):
+    # Một lần đọc theo khóa chính; cộng thêm lãi của các click chưa kịp ghi xuống DB
+    row = await run_db(_fetch_balance, user_id)
+    if row is None:
+        return 0, 0, 0
+    deposited_amount, withdrawn_amount, balance, income_today = row
+    pending = click_accumulator.pending.get(user_id)
+    if pending:
+        income_today += pending[1]
+    return deposited_amount, withdrawn_amount, balance + income_today
+
+async def run_daily_accrual() -> dict:
+    # Ghi nốt các click đang gom để lãi của cả ngày được tính
+    started = time.perf_counter()
+    await click_accumulator.flush()
+    flush_seconds = time.perf_counter() - started
+
+    stats = await run_db(_daily_accrual, time.time())
+    stats['flush_seconds'] = flush_seconds
+
+    started = time.perf_counter()
+    reset_cached_counters()
+    if SHARD_COUNT > 1:
+        # Các tiến trình khác chỉ đặt lại bộ nhớ đệm; click còn trong bộ gom của họ được ghi
+        # sau lần đặt lại trong DB nên thuộc về ngày mới, khớp với bộ đếm trong bộ nhớ
+        send_to_shard('others', ('daily_reset',))
+    stats['cache_seconds'] = time.perf_counter() - started
+    return stats
+
+def reset_cached_counters():
+    # Bộ đếm trong bộ nhớ về 0, giữ lại các click chưa ghi xuống DB (đã thuộc ngày mới)
+    for state in itertools.chain(user_cache.values(), evicted_dirty_users.values()):
+        pending = click_accumulator.pending.get(state.user_id)
+        state.click_count, state.income_today = (pending[0], pending[1]) if pending else (0, 0)
+
+async def daily_accrual_job(context: ContextTypes.DEFAULT_TYPE):
+    started = time.perf_counter()
+    stats = await run_daily_accrual()
+    report = (
+        "🌙 Tác vụ cuối ngày hoàn tất trong "
+        f"{time.perf_counter() - started:.2f}s\n"
+        f"Ghi click còn lại: {stats['flush_seconds']:.3f}s\n"
+        f"Ghi lãi: {stats['interest_rows']} người dùng, {stats['post_seconds']:.3f}s\n"
+        f"Đặt lại bộ đếm: {stats['reset_rows']} người dùng, {stats['reset_seconds']:.3f}s\n"
+        f"Bộ nhớ đệm: {stats['cache_seconds']:.3f}s"
+    )
+    logging.info(report.replace("\n", " | "))
+    outbound_queue.send(admin_user_id, report, priority=PRIORITY_ADMIN)
+
+async def flush_user_states():
+    states = [s for s in user_cache.values() if s.dirty]
+    states.extend(evicted_dirty_users.values())
+    evicted_dirty_users.clear()
+    if not states:
+        return 0
+
+    # Chụp lại giá trị trên event loop rồi ghi cả lô trong một transaction
+    rows = []
+    for state in states:
+        rows.append(state.as_row())
+        state.dirty = False
+    try:
+        chunks = [rows[i:i + CRYPTO_CHUNK_SIZE] for i in range(0, len(rows), CRYPTO_CHUNK_SIZE)]
+        encrypted = []
+        for chunk in await asyncio.gather(*(run_crypto(_encrypt_rows, chunk) for chunk in chunks)):
+            encrypted.extend(chunk)
+        await run_db(_save_many_user_data, encrypted)
+    except Exception as e:
+        logging.error(f"Lỗi khi lưu dữ liệu: {e}")
+        for state in states:
+            state.dirty = True
+            if state.user_id not in user_cache:
+                evicted_dirty_users[state.user_id] = state
+        return 0
+
+    # Giữ lại bản mã vừa tạo, trừ trường đã bị sửa tiếp trong lúc đang ghi
+    for state, row, saved in zip(states, rows, encrypted):
+        for i, field in enumerate(PII_FIELDS):
+            if getattr(state, field) == row[1][i][0]:
+                state.encrypted[i] = saved[1 + i]
+    return len(rows)
+
+async def flush_user_states_job(context: ContextTypes.DEFAULT_TYPE):
+    await flush_user_states()
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated_at')
+
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+    def consume(self, capacity: float, rate: float, now: float) -> bool:
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+# Token bucket cho từng (hành động, khóa). Bucket nhàn rỗi đủ lâu đã đầy lại nên
+# việc đẩy bucket cũ nhất ra khỏi LRU không làm thay đổi kết quả giới hạn.
+class RateLimiter:
+    def __init__(self, limits: dict, max_buckets: int):
+        self.limits = {action: (burst, 1 / interval, scope) for action, (burst, interval, scope) in limits.items()}
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+
+    def allow(self, action: str, key: int, now: float = None) -> bool:
+        capacity, rate, _ = self.limits[action]
+        if now is None:
+            now = time.monotonic()
+        bucket_key = (action, key)
+        bucket = self.buckets.get(bucket_key)
+        if bucket is None:
+            bucket = TokenBucket(capacity, now)
+            self.buckets[bucket_key] = bucket
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(bucket_key)
+        return bucket.consume(capacity, rate, now)
+
+    def retry_after(self, action: str, key: int, now: float = None) -> float:
+        # Số giây tới khi bucket có lại một lượt, không tiêu lượt nào
+        capacity, rate, _ = self.limits[action]
+        bucket = self.buckets.get((action, key))
+        if bucket is None:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        tokens = min(capacity, bucket.tokens + (now - bucket.updated_at) * rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+    def check(self, action: str, update: Update) -> bool:
+        scope = self.limits[action][2]
+        key = update.effective_chat.id if scope == 'chat' else update.effective_user.id
+        return self.allow(action, key)
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMITER_SIZE)
+
+# Gom các lượt click theo người dùng để ghi bằng một executemany cho mỗi chu kỳ
+class ClickAccumulator:
+    def __init__(self, max_delay: float, max_batch: int):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.pending = {}
+        self._lock = asyncio.Lock()
+        self._flush_task = None
+
+    def add(self, user_id: int, interest: float):
+        entry = self.pending.get(user_id)
+        if entry is None:
+            self.pending[user_id] = [1, interest]
+        else:
+            entry[0] += 1
+            entry[1] += interest
+        # Đủ lô thì ghi ngay, không chờ tới chu kỳ kế tiếp
+        if len(self.pending) >= self.max_batch and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            rows = [(clicks, interest, user_id) for user_id, (clicks, interest) in batch.items()]
             try:
-                cursor.execute('BEGIN TRANSACTION;')
-                cursor.execute('''
-                    INSERT INTO users (user_id, account_number, bank_name, phone_number, 
-                                       deposited_amount, withdrawn_amount, income_today, click_count)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(user_id) DO UPDATE SET
-                        account_number = excluded.account_number,
-                        bank_name = excluded.bank_name,
-                        phone_number = excluded.phone_number,
-                        deposited_amount = excluded.deposited_amount,
-                        withdrawn_amount = excluded.withdrawn_amount,
-                        income_today = excluded.income_today,
-                        click_count = excluded.click_count
-                ''', user_data)
-                cursor.execute('COMMIT;')
+                await run_db(_add_clicks, rows)
             except Exception as e:
-                cursor.execute('ROLLBACK;')
-                logging.error(f"Lỗi khi lưu dữ liệu: {e}")
+                logging.error(f"Lỗi khi lưu lượt click: {e}")
+                # Trả lô về bộ gom để thử lại ở chu kỳ sau
+                for user_id, (clicks, interest) in batch.items():
+                    entry = self.pending.setdefault(user_id, [0, 0])
+                    entry[0] += clicks
+                    entry[1] += interest
+                return 0
+            return len(rows)
 
-async def send_user_notification(user_chat_id: int, message: str):
+click_accumulator = ClickAccumulator(CLICK_FLUSH_INTERVAL, CLICK_FLUSH_BATCH)
+
+async def flush_clicks_job(context: ContextTypes.DEFAULT_TYPE):
+    await click_accumulator.flush()
+
+# Bộ nhớ chống lặp: khóa -> thời điểm nhận, cũ nhất ở đầu. Kiểm tra chỉ tra dict trong event
+# loop; bảng processed_updates được ghi theo lô và nạp lại khi khởi động.
+class UpdateDeduper:
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.seen = OrderedDict()
+        self.unsaved = []
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def keys(update: Update) -> tuple:
+        # Một callback query có thể tới trong update khác (gửi lại sau khi đặt lại webhook)
+        query = update.callback_query
+        if query is not None:
+            return (f'u:{update.update_id}', f'c:{query.id}')
+        return (f'u:{update.update_id}',)
+
+    @staticmethod
+    def persistent(update: Update) -> bool:
+        # Chỉ lệnh duyệt/từ chối của admin (nút bấm và /approve, /deny) được lưu bền. Click và
+        # các update khác chỉ nằm trong bộ nhớ; tin nhắn số tiền nạp/rút/chuyển đã có khóa chống
+        # lặp riêng trong pending_transactions.
+        query = update.callback_query
+        if query is not None:
+            return (query.data or '').startswith(PERSISTED_CALLBACK_PREFIXES)
+        message = update.message
+        return message is not None and (message.text or '').startswith(PERSISTED_COMMANDS)
+
+    def check(self, update: Update) -> bool:
+        # True và ghi nhận nếu update chưa từng thấy, False nếu là bản lặp
+        keys = self.keys(update)
+        seen = self.seen
+        for key in keys:
+            if key in seen:
+                return False
+        now = time.time()
+        for key in keys:
+            seen[key] = now
+        if self.persistent(update):
+            self.unsaved.extend((key, now) for key in keys)
+        while seen:
+            oldest = next(iter(seen.values()))
+            if oldest > now - self.ttl and len(seen) <= self.max_size:
+                break
+            seen.popitem(last=False)
+        return True
+
+    def load(self, rows: list):
+        # rows mới nhất trước, như SQL_SELECT_PROCESSED_UPDATES trả về
+        for key, seen_at in reversed(rows):
+            self.seen[key] = seen_at
+
+    async def flush(self):
+        async with self._lock:
+            if not self.unsaved:
+                return 0
+            batch, self.unsaved = self.unsaved, []
+            try:
+                await run_db(_save_processed_updates, batch, time.time() - self.ttl)
+            except Exception as e:
+                logging.error(f"Lỗi khi lưu danh sách update đã nhận: {e}")
+                self.unsaved = (batch + self.unsaved)[-self.max_size:]
+                return 0
+            return len(batch)
+
+update_deduper = UpdateDeduper(DEDUPE_TTL, DEDUPE_CACHE_SIZE)
+
+async def flush_processed_updates_job(context: ContextTypes.DEFAULT_TYPE):
+    await update_deduper.flush()
+
+async def shutdown_db(application):
+    await flush_user_states()
+    await click_accumulator.flush()
+    await update_deduper.flush()
+    await run_db(close_db)
+    db_executor.shutdown(wait=True)
+    crypto_executor.shutdown(wait=True)
+
+class OutboundMessage:
+    __slots__ = ('chat_id', 'text', 'reply_markup', 'message_id', 'priority', 'attempts', 'on_done')
+
+    def __init__(self, chat_id: int, text: str, reply_markup, message_id, priority: int, on_done=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        # Có message_id nghĩa là sửa tin đã gửi thay vì gửi tin mới
+        self.message_id = message_id
+        self.priority = priority
+        self.attempts = 0
+        # Gọi một lần với kết quả cuối cùng ('sent', 'forbidden' hoặc 'failed') và message_id
+        # của tin đã gửi (None nếu không gửi được)
+        self.on_done = on_done
+
+# Hàng đợi gửi tin ra Telegram: tôn trọng giới hạn toàn bot và theo chat, gửi theo độ ưu tiên,
+# thử lại với backoff lũy thừa (hoặc đúng thời gian RetryAfter) và gộp các lần sửa liên tiếp
+# của cùng một tin thành một lần gửi với nội dung mới nhất.
+class OutboundQueue:
+    def __init__(self, limiter: RateLimiter, concurrency: int, max_retries: int, backoff_base: float):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.bot = None
+        self._ready = []
+        self._delayed = []
+        self._edits = {}
+        self._held_until = {}
+        self._seq = itertools.count()
+        self._inflight = set()
+        self._concurrency = concurrency
+        self._semaphore = None
+        self._wakeup = None
+        self._worker = None
+
+    def __len__(self):
+        return len(self._ready) + len(self._delayed) + len(self._inflight)
+
+    def send(self, chat_id: int, text: str, reply_markup=None, priority: int = PRIORITY_USER, on_done=None):
+        self._push(OutboundMessage(chat_id, text, reply_markup, None, priority, on_done))
+
+    def edit(self, chat_id: int, message_id: int, text: str, reply_markup=None, priority: int = PRIORITY_EDIT):
+        key = (chat_id, message_id)
+        pending = self._edits.get(key)
+        if pending is not None:
+            pending.text = text
+            pending.reply_markup = reply_markup
+            return
+        item = OutboundMessage(chat_id, text, reply_markup, message_id, priority)
+        self._edits[key] = item
+        self._push(item)
+
+    def _push(self, item: OutboundMessage, ready_at: float = 0.0):
+        if ready_at > time.monotonic():
+            heapq.heappush(self._delayed, (ready_at, next(self._seq), item))
+        else:
+            heapq.heappush(self._ready, (item.priority, next(self._seq), item))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self, bot):
+        self.bot = bot
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        # Cố gửi nốt các tin còn trong hàng đợi trước khi dừng
+        deadline = time.monotonic() + timeout
+        while len(self) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        if len(self):
+            logging.warning(f"Bỏ {len(self)} tin nhắn chưa gửi khi dừng bot")
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, item = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (item.priority, next(self._seq), item))
+
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            wait = self.limiter.retry_after('send_global', 0, now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, _, item = heapq.heappop(self._ready)
+            held_until = self._held_until.get(item.chat_id)
+            if held_until is not None:
+                if held_until > now:
+                    self._push(item, held_until)
+                    continue
+                del self._held_until[item.chat_id]
+            if not self.limiter.allow('send_chat', item.chat_id, now):
+                self._push(item, now + self.limiter.retry_after('send_chat', item.chat_id, now))
+                continue
+            self.limiter.allow('send_global', 0, now)
+
+            if item.message_id is not None:
+                self._edits.pop((item.chat_id, item.message_id), None)
+            await self._semaphore.acquire()
+            task = asyncio.get_running_loop().create_task(self._deliver(item))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, item: OutboundMessage):
+        try:
+            if item.message_id is None:
+                sent = await self.bot.send_message(chat_id=item.chat_id, text=item.text, reply_markup=item.reply_markup)
+            else:
+                sent = await self.bot.edit_message_text(chat_id=item.chat_id, message_id=item.message_id,
+                                                 text=item.text, reply_markup=item.reply_markup)
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+            logging.warning(f"Telegram giới hạn tốc độ chat {item.chat_id}, thử lại sau {delay} giây")
+            self._held_until[item.chat_id] = time.monotonic() + delay
+            metrics.inc('bot_outbound_messages_total', (('result', 'retry_after'),))
+            self._retry(item, delay)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logging.error(f"Lỗi khi gửi tin nhắn tới {item.chat_id}: {e}")
+            metrics.inc('bot_outbound_messages_total', (('result', 'bad_request'),))
+            self._finish(item, 'failed')
+        except Forbidden as e:
+            logging.warning(f"Không thể gửi tin nhắn tới {item.chat_id}: {e}")
+            metrics.inc('bot_outbound_messages_total', (('result', 'forbidden'),))
+            self._finish(item, 'forbidden')
+        except NetworkError as e:
+            logging.warning(f"Lỗi mạng khi gửi tin nhắn tới {item.chat_id}: {e}")
+            metrics.inc('bot_outbound_messages_total', (('result', 'network_error'),))
+            self._retry(item, self.backoff_base * 2 ** item.attempts)
+        except Exception as e:
+            logging.error(f"Lỗi khi gửi tin nhắn tới {item.chat_id}: {e}")
+            metrics.inc('bot_outbound_messages_total', (('result', 'error'),))
+            self._finish(item, 'failed')
+        else:
+            metrics.inc('bot_outbound_messages_total', (('result', 'sent'),))
+            self._finish(item, 'sent', getattr(sent, 'message_id', item.message_id))
+        finally:
+            self._semaphore.release()
+
+    @staticmethod
+    def _finish(item: OutboundMessage, result: str, message_id: int = None):
+        if item.on_done is not None:
+            item.on_done(result, message_id)
+
+    def _retry(self, item: OutboundMessage, delay: float):
+        item.attempts += 1
+        if item.attempts > self.max_retries:
+            logging.error(f"Bỏ tin nhắn tới {item.chat_id} sau {self.max_retries} lần thử lại")
+            metrics.inc('bot_outbound_messages_total', (('result', 'dropped'),))
+            self._finish(item, 'failed')
+            return
+        if item.message_id is not None:
+            key = (item.chat_id, item.message_id)
+            # Đã có nội dung sửa mới hơn trong hàng đợi thì bản cũ này không cần gửi lại
+            if key in self._edits:
+                return
+            self._edits[key] = item
+        self._push(item, time.monotonic() + delay)
+
+outbound_limiter = RateLimiter({
+    'send_global': (SEND_GLOBAL_RATE, 1 / SEND_GLOBAL_RATE, 'chat'),
+    'send_chat': (SEND_CHAT_BURST, SEND_CHAT_INTERVAL, 'chat'),
+}, RATE_LIMITER_SIZE)
+outbound_queue = OutboundQueue(outbound_limiter, SEND_CONCURRENCY, SEND_MAX_RETRIES, SEND_BACKOFF_BASE)
+
+# Gửi một tin tới mọi người dùng qua hàng đợi gửi tin với độ ưu tiên thấp nhất, nên tin của
+# người dùng và admin vẫn đi trước. Người nhận được đọc theo user_id tăng dần; mốc
+# last_user_id chỉ tiến tới khi mọi người nhận trước đó đã có kết quả, nên khi khởi động lại
+# bot tiếp tục từ mốc này (các tin đang gửi dở lúc dừng có thể được gửi lại một lần).
+class BroadcastJob:
+    def __init__(self, row: tuple):
+        self.id, self.text, self.last_user_id, self.total, self.sent, self.failed, self.blocked, self.message_id = row
+        self.cancelled = False
+        self.task = None
+        # user_id -> đã có kết quả chưa, theo thứ tự gửi
+        self._outstanding = OrderedDict()
+        self._blocked_ids = []
+        self._window = asyncio.Semaphore(BROADCAST_WINDOW)
+        self._started = time.monotonic()
+        self._processed_at_start = self.processed
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def _on_done(self, user_id: int, result: str, message_id: int):
+        if result == 'sent':
+            self.sent += 1
+        elif result == 'forbidden':
+            self.blocked += 1
+            self._blocked_ids.append(user_id)
+        else:
+            self.failed += 1
+        self._outstanding[user_id] = True
+        while self._outstanding:
+            first_id, done = next(iter(self._outstanding.items()))
+            if not done:
+                break
+            self._outstanding.popitem(last=False)
+            self.last_user_id = first_id
+        self._window.release()
+
+    async def checkpoint(self, status: str = 'running'):
+        blocked_ids, self._blocked_ids = self._blocked_ids, []
+        progress = (self.last_user_id, self.sent, self.failed, self.blocked, status, time.time(), self.id)
+        await run_db(_save_broadcast, progress, blocked_ids, time.time())
+
+    def progress_message(self) -> str:
+        elapsed = time.monotonic() - self._started
+        rate = (self.processed - self._processed_at_start) / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.processed, 0)
+        eta = str(datetime.timedelta(seconds=int(remaining / rate))) if rate > 0 else "chưa rõ"
+        percent = self.processed / self.total * 100 if self.total else 100.0
+        return (
+            f"📣 Gửi tin hàng loạt #{self.id}: {self.processed}/{self.total} ({percent:.1f} %)\n"
+            f"✅ Đã gửi: {self.sent}\n"
+            f"🚫 Đã chặn bot: {self.blocked}\n"
+            f"❌ Lỗi: {self.failed}\n"
+            f"⚡ Tốc độ: {rate:.1f} tin/giây, còn khoảng {eta}"
+        )
+
+    def report(self):
+        if self.message_id is not None:
+            outbound_queue.edit(admin_user_id, self.message_id, self.progress_message(), priority=PRIORITY_ADMIN)
+
+    async def run(self):
+        global active_broadcast
+        try:
+            status = await self._send_all()
+        except Exception as e:
+            # Lượt gửi vẫn ở trạng thái 'running' trong DB: tiếp tục bằng /broadcast hoặc khi khởi động lại
+            logging.error(f"Lỗi khi gửi tin hàng loạt #{self.id}: {e}")
+            active_broadcast = None
+            try:
+                # Ghi mốc sau khi các tin đã xếp hàng có kết quả, để lần tiếp tục không gửi lặp
+                await self._drain()
+                await self.checkpoint()
+            except Exception as e:
+                logging.error(f"Không ghi được mốc tiến độ gửi tin hàng loạt #{self.id}: {e}")
+            outbound_queue.send(admin_user_id, f"❌ Gửi tin hàng loạt #{self.id} bị dừng do lỗi: {e}\n"
+                                f"Đã xử lý {self.processed}/{self.total}. Gửi /broadcast để tiếp tục.", priority=PRIORITY_ADMIN)
+            return
+        active_broadcast = None
+        self.report()
+        outbound_queue.send(admin_user_id, f"{'⏹ Đã dừng' if self.cancelled else '✅ Đã hoàn tất'} gửi tin hàng loạt #{self.id}: "
+                            f"{self.sent} đã gửi, {self.blocked} đã chặn bot, {self.failed} lỗi.", priority=PRIORITY_ADMIN)
+        logging.info(f"Gửi tin hàng loạt #{self.id} kết thúc ({status}): {self.sent} đã gửi, "
+                     f"{self.blocked} đã chặn bot, {self.failed} lỗi")
+
+    async def _drain(self):
+        # Chờ kết quả của các tin còn trong hàng đợi
+        for _ in range(BROADCAST_WINDOW):
+            await self._window.acquire()
+
+    async def _send_all(self) -> str:
+        if self.message_id is None:
+            # Tin tiến độ cũng đi qua hàng đợi gửi tin (giới hạn tốc độ, RetryAfter); chờ để lấy
+            # message_id rồi sau đó chỉ sửa tin này. Không gửi được thì chạy tiếp, không báo tiến độ.
+            sent = asyncio.get_running_loop().create_future()
+
+            def on_sent(result: str, message_id: int):
+                if not sent.done():
+                    sent.set_result(message_id)
+
+            outbound_queue.send(admin_user_id, self.progress_message(), priority=PRIORITY_ADMIN, on_done=on_sent)
+            self.message_id = await sent
+            if self.message_id is not None:
+                await run_db(_set_broadcast_message, self.id, self.message_id)
+
+        next_checkpoint = next_report = time.monotonic()
+        after_user_id = self.last_user_id
+        while not self.cancelled:
+            user_ids = await run_db(_fetch_broadcast_batch, after_user_id, BROADCAST_BATCH)
+            if not user_ids:
+                break
+            for user_id in user_ids:
+                await self._window.acquire()
+                if self.cancelled:
+                    self._window.release()
+                    break
+                self._outstanding[user_id] = False
+                outbound_queue.send(user_id, self.text, priority=PRIORITY_BROADCAST,
+                                    on_done=functools.partial(self._on_done, user_id))
+                now = time.monotonic()
+                if now >= next_checkpoint:
+                    next_checkpoint = now + BROADCAST_CHECKPOINT_INTERVAL
+                    await self.checkpoint()
+                if now >= next_report:
+                    next_report = now + BROADCAST_REPORT_INTERVAL
+                    self.report()
+            after_user_id = user_ids[-1]
+
+        await self._drain()
+        status = 'cancelled' if self.cancelled else 'done'
+        await self.checkpoint(status)
+        return status
+
+active_broadcast = None
+
+def start_broadcast(row: tuple) -> BroadcastJob:
+    global active_broadcast
+    job = BroadcastJob(row)
+    job.task = asyncio.get_running_loop().create_task(job.run())
+    active_broadcast = job
+    return job
+
+async def stop_broadcast():
+    # Khi tắt bot: dừng đọc người nhận; mốc tiến độ được ghi sau khi hàng đợi gửi tin đã xả
+    job = active_broadcast
+    if job is None or job.task is None:
+        return None
+    job.task.cancel()
     try:
-        await application.bot.send_message(chat_id=user_chat_id, text=message)
-    except Exception as e:
-        logging.error(f"Lỗi khi gửi tin nhắn: {e}")
-        await application.bot.send_message(chat_id=user_chat_id, text="❌ Đã xảy ra lỗi khi xử lý yêu cầu của bạn. Vui lòng thử lại.")
+        await job.task
+    except asyncio.CancelledError:
+        pass
+    return job
+
+# Số giao dịch chờ duyệt được làm mới theo chu kỳ thay vì đếm trong mỗi lần scrape
+pending_count = 0
+
+async def refresh_pending_count_job(context: ContextTypes.DEFAULT_TYPE):
+    global pending_count
+    pending_count = await run_db(_count_pending)
+
+metrics.gauge('bot_outbound_queue_depth', 'Tin nhắn đang chờ hoặc đang gửi', lambda: len(outbound_queue))
+metrics.gauge('bot_pending_transactions', 'Giao dịch đang chờ admin duyệt', lambda: pending_count)
+metrics.gauge('bot_click_accumulator_users', 'Người dùng có lượt click chưa ghi xuống DB', lambda: len(click_accumulator.pending))
+metrics.gauge('bot_user_cache_size', 'Trạng thái người dùng trong bộ nhớ đệm', lambda: len(user_cache))
+metrics.gauge('bot_dedupe_cache_size', 'Khóa update đã nhận trong bộ nhớ chống lặp', lambda: len(update_deduper.seen))
 
-async def notify_admin(user_id: int, user_info: str, action: str, amount: float, user_chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+async def start_application(application):
+    await run_db(migrate_db)
+    # Khóa sai hoặc thiếu thì dừng ngay khi khởi động, không phải ở lần giải mã đầu tiên
+    get_cipher_suite()
+    update_deduper.load(await run_db(_fetch_processed_updates, time.time() - DEDUPE_TTL, DEDUPE_CACHE_SIZE))
+    outbound_queue.start(application.bot)
+    await start_metrics_server()
+    row = await run_db(_fetch_running_broadcast) if is_leader() else None
+    if row is not None:
+        logging.info(f"Tiếp tục gửi tin hàng loạt #{row[0]} từ sau người dùng {row[2]}")
+        start_broadcast(row)
+
+# post_stop: chạy sau Application.stop() nhưng trước shutdown(), khi kết nối HTTP của bot còn
+# mở nên hàng đợi gửi tin còn gửi nốt được (kết quả duyệt, tin cho admin); tới post_shutdown
+# thì bot.shutdown() đã đóng kết nối.
+async def stop_application(application):
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    broadcast = await stop_broadcast()
+    await outbound_queue.stop()
+    if broadcast is not None:
+        await broadcast.checkpoint()
+
+async def shutdown_application(application):
+    await shutdown_db(application)
+
+async def send_user_notification(user_chat_id: int, message: str):
+    outbound_queue.send(user_chat_id, message, priority=PRIORITY_USER)
+
+async def notify_admin(update: Update, user_id: int, user_info: str, action: str, amount: float, recipient_id: int = None):
+    # Lưu giao dịch vào hàng đợi bền trước, nút bấm của admin mang theo mã giao dịch
+    idempotency_key = f"{update.effective_chat.id}:{update.message.message_id}"
+    pending_id = await run_db(_insert_pending, user_id, action, amount, recipient_id, user_info, idempotency_key)
+    if pending_id is None:
+        logging.info(f"Bỏ qua giao dịch lặp {idempotency_key} của người dùng {user_id}")
+        return
     message = (
-        f"📥 Người dùng (ID: {user_id}) đã {action} tiền: {amount} VND\n"
-        f"Thông tin: {user_info}\n"
+        f"📥 Người dùng (ID: {user_id}) đã {TRANSACTION_VERBS[action]} tiền: {amount} VND\n"
+        + (f"Người nhận: {recipient_id}\n" if recipient_id else "")
+        + f"Thông tin: {user_info}\n"
+        f"Mã giao dịch: #{pending_id}\n"
         f"Bạn có muốn duyệt không?"
     )
-    context.user_data['pending_transaction'] = {'action': action, 'amount': amount, 'user_chat_id': user_chat_id}
     
     keyboard = [
-        [InlineKeyboardButton("Duyệt", callback_data='approve_transaction')],
-        [InlineKeyboardButton("Không Duyệt", callback_data='deny_transaction')]
+        [InlineKeyboardButton("Duyệt", callback_data=f'approve_transaction:{pending_id}')],
+        [InlineKeyboardButton("Không Duyệt", callback_data=f'deny_transaction:{pending_id}')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await send_user_notification(user_chat_id, "🔄 Đang xử lý giao dịch...")
-    await context.bot.send_message(chat_id=admin_user_id, text=message, reply_markup=reply_markup)
+    await send_user_notification(user_id, "🔄 Đang xử lý giao dịch...")
+    outbound_queue.send(admin_user_id, message, reply_markup, priority=PRIORITY_ADMIN)
+
+def transaction_result_message(result: tuple) -> str:
+    _, _, action, amount, recipient_id, status = result
+    name = "chuyển khoản" if action == 'transfer' else f"{TRANSACTION_VERBS[action]} tiền"
+    if status == 'ok':
+        if action == 'transfer':
+            return f"✅ Giao dịch chuyển khoản {amount} VND đến người dùng (ID: {recipient_id}) thành công!"
+        return f"✅ Giao dịch {name} {amount} VND thành công!"
+    if status == 'denied':
+        return f"❌ Giao dịch {name} {amount} VND đã bị từ chối!"
+    if status == 'insufficient':
+        return f"❌ Giao dịch {name} {amount} VND thất bại do số dư không đủ!"
+    return "❌ Người nhận không tồn tại."
+
+def apply_cached_balance(user_id: int, balance_row: tuple):
+    state = user_cache.get(user_id) or evicted_dirty_users.get(user_id)
+    if state:
+        state.apply_balance(balance_row)
+
+async def resolve_pending_transactions(ids, approve: bool, id_range: tuple = None) -> list:
+    results, balances = await run_db(_resolve_pending, ids, approve, id_range)
+    for user_id, balance_row in balances.items():
+        if owns_user(user_id):
+            apply_cached_balance(user_id, balance_row)
+        else:
+            send_to_shard(shard_of(user_id), ('balance', user_id, tuple(balance_row)))
+    # Một lượt gửi thông báo cho toàn bộ kết quả; hàng đợi gửi tin lo phần giới hạn tốc độ
+    for result in results:
+        logging.info(f"Giao dịch #{result[0]} ({result[2]} {result[3]} VND, người dùng {result[1]}): {result[5]}")
+        await send_user_notification(result[1], transaction_result_message(result))
+    return results
+
+def is_admin(update: Update) -> bool:
+    return update.effective_user is not None and update.effective_user.id == admin_user_id
+
+def _callback_pending_id(data: str):
+    _, _, pending_id = data.partition(':')
+    return int(pending_id) if pending_id.isdigit() else None
 
 async def approve_transaction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    transaction = context.user_data.get('pending_transaction')
-    if not transaction:
+    await _resolve_from_callback(update, approve=True)
+
+async def deny_transaction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _resolve_from_callback(update, approve=False)
+
+async def _resolve_from_callback(update: Update, approve: bool):
+    query = update.callback_query
+    if not is_admin(update):
+        await query.answer("Bạn không có quyền duyệt giao dịch.")
+        return
+    pending_id = _callback_pending_id(query.data)
+    results = await resolve_pending_transactions([pending_id], approve) if pending_id else []
+    if not results:
         logging.warning("Không có giao dịch nào để phê duyệt.")
+        await query.answer("Giao dịch không tồn tại hoặc đã được xử lý.")
         return
+    status = results[0][5]
+    if status == 'ok':
+        await query.answer("Giao dịch đã được phê duyệt!")
+    elif status == 'denied':
+        await query.answer("Giao dịch đã bị từ chối!")
+    else:
+        await query.answer(transaction_result_message(results[0]))
 
-    user_chat_id = transaction['user_chat_id']
-    action = transaction['action']
-    amount = transaction['amount']
-    
-    global bank_account_info
-    message = ""
-
-    logging.info(f"Phê duyệt giao dịch: {action} {amount} VND từ người dùng {user_chat_id}")
-
-    if action == "nạp":
-        bank_account_info['deposited_amount'] += amount
-        message = f"✅ Giao dịch nạp tiền {amount} VND thành công!"
-    elif action == "rút":
-        total_balance = bank_account_info['deposited_amount'] + (click_count * (bank_account_info['deposited_amount'] * 0.00005))
-        if amount <= total_balance:
-            bank_account_info['withdrawn_amount'] += amount
-            bank_account_info['deposited_amount'] -= amount
-            message = f"✅ Giao dịch rút tiền {amount} VND thành công!"
+async def pending_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /pending và nút "Trang sau": phân trang hàng đợi theo id
+    if not is_admin(update):
+        return
+    query = update.callback_query
+    after_id = 0
+    if query:
+        await query.answer()
+        after_id = int(query.data.split(':')[1])
+
+    rows, total = await run_db(_fetch_pending_page, after_id, PENDING_PAGE_SIZE)
+    if not rows:
+        text = "✅ Không có giao dịch nào chờ duyệt."
+        reply_markup = None
+    else:
+        lines = [f"📋 Giao dịch chờ duyệt ({total}):"]
+        for pending_id, user_id, action, amount, recipient_id, user_info in rows:
+            recipient = f" → {recipient_id}" if recipient_id else ""
+            lines.append(f"#{pending_id} - {TRANSACTION_LABELS[action]} {amount} VND - ID {user_id}{recipient} ({user_info})")
+        lines.append("Duyệt theo mã: /approve <mã> ... hoặc /approve all, từ chối: /deny <mã> ...")
+        text = "\n".join(lines)
+        # Nút mang theo khoảng mã của chính trang này: bấm nút trên tin cũ vẫn chỉ xử lý trang đó
+        page = f'{rows[0][0]}:{rows[-1][0]}'
+        keyboard = [[
+            InlineKeyboardButton("Duyệt trang này", callback_data=f'approve_page:{page}'),
+            InlineKeyboardButton("Từ chối trang này", callback_data=f'deny_page:{page}'),
+        ]]
+        if len(rows) == PENDING_PAGE_SIZE:
+            keyboard.append([InlineKeyboardButton("Trang sau", callback_data=f'pending_page:{rows[-1][0]}')])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+    if query:
+        await query.message.reply_text(text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+def _resolve_summary(results: list, approve: bool) -> str:
+    succeeded = sum(1 for r in results if r[5] in ('ok', 'denied'))
+    failed = len(results) - succeeded
+    summary = f"{'✅ Đã duyệt' if approve else '❌ Đã từ chối'} {succeeded} giao dịch."
+    if failed:
+        summary += f" {failed} giao dịch thất bại (số dư không đủ hoặc người nhận không tồn tại)."
+    return summary
+
+async def page_resolve_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if not is_admin(update):
+        await query.answer("Bạn không có quyền duyệt giao dịch.")
+        return
+    action, _, page = query.data.partition(':')
+    first_id, _, last_id = page.partition(':')
+    if not (first_id.isdigit() and last_id.isdigit()):
+        await query.answer("Trang này đã cũ, hãy gọi lại /pending.")
+        return
+    approve = action == 'approve_page'
+    # Chỉ các giao dịch của trang còn đang chờ: trang đã xử lý thì không còn gì để duyệt
+    results = await resolve_pending_transactions(None, approve, (int(first_id), int(last_id)))
+    if not results:
+        await query.answer("Trang này đã được xử lý, hãy gọi lại /pending.")
+        return
+    await query.answer()
+    await query.message.reply_text(_resolve_summary(results, approve))
+
+async def approve_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _resolve_from_command(update, context, approve=True)
+
+async def deny_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _resolve_from_command(update, context, approve=False)
+
+async def _resolve_from_command(update: Update, context: ContextTypes.DEFAULT_TYPE, approve: bool):
+    # /approve all | /approve 12 15 18 (tương tự với /deny), áp dụng trong một transaction
+    if not is_admin(update):
+        return
+    args = context.args or []
+    command = 'approve' if approve else 'deny'
+    try:
+        ids = None if args == ['all'] else [int(arg.lstrip('#')) for arg in args]
+    except ValueError:
+        ids = []
+    if ids == []:
+        await update.message.reply_text(f"Cách dùng: /{command} <mã> [<mã> ...] hoặc /{command} all")
+        return
+    results = await resolve_pending_transactions(ids, approve)
+    await update.message.reply_text(_resolve_summary(results, approve))
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /profile [giây]: lấy mẫu ngăn xếp mọi luồng, gửi các ngăn xếp xuất hiện nhiều nhất cho admin
+    if not is_admin(update):
+        return
+    args = context.args or []
+    duration = min(float(args[0]), 60.0) if args and args[0].replace('.', '', 1).isdigit() else 5.0
+    await update.message.reply_text(f"⏱ Đang lấy mẫu trong {duration:g} giây...")
+    counts, samples = await asyncio.to_thread(sample_stacks, duration)
+    lines = [f"⏱ {samples} lần lấy mẫu trong {duration:g} giây:"]
+    for (thread_name, stack), count in counts.most_common(PROFILE_TOP_STACKS):
+        lines.append(f"\n{count / samples:.0%} [{thread_name}]")
+        lines.extend(f"  {frame}" for frame in stack)
+    if not counts:
+        lines.append("Không có luồng nào bận.")
+    outbound_queue.send(admin_user_id, "\n".join(lines)[:4000], priority=PRIORITY_ADMIN)
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /export [users|transactions] [csv|jsonl]: gửi cho admin file nén gzip của cả bảng
+    if not is_admin(update):
+        return
+    args = context.args or []
+    table = args[0] if args else 'users'
+    fmt = args[1] if len(args) > 1 else 'csv'
+    if table not in EXPORT_TABLES or fmt not in EXPORT_FORMATS:
+        await update.message.reply_text(f"Cách dùng: /export [{'|'.join(EXPORT_TABLES)}] [{'|'.join(EXPORT_FORMATS)}]")
+        return
+
+    await update.message.reply_text(f"⏳ Đang xuất {table}...")
+    if table == 'users':
+        # Ghi các thay đổi còn trong bộ nhớ để file xuất khớp với những gì người dùng thấy
+        await flush_user_states()
+        await click_accumulator.flush()
+
+    filename = f"{table}-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}.gz"
+    # EXPORT_DIR mặc định là thư mục tạm dùng chung: tạo file với tên ngẫu nhiên (O_EXCL, 0600)
+    # để người dùng khác không đoán trước được đường dẫn mà đặt symlink vào
+    fd, path = tempfile.mkstemp(dir=EXPORT_DIR, prefix=f'{table}-', suffix=f'.{fmt}.gz')
+    os.close(fd)
+    started = time.perf_counter()
+    try:
+        count = await asyncio.to_thread(export_table, table, fmt, path)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        logging.error(f"Lỗi khi xuất {table}: {e}")
+        await update.message.reply_text(f"❌ Xuất {table} thất bại: {e}")
+        return
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(path)
+    logging.info(f"Đã xuất {count} hàng {table} vào {path} ({size} byte, {elapsed:.1f}s)")
+
+    caption = f"📦 {table}: {count} hàng, {elapsed:.1f} giây"
+    if size > EXPORT_MAX_UPLOAD:
+        await update.message.reply_text(f"{caption}\nFile {size // (1024 * 1024)} MB quá lớn để gửi qua Telegram, đã lưu tại {path}")
+        return
+    try:
+        with open(path, 'rb') as f:
+            await update.message.reply_document(document=f, filename=filename, caption=caption)
+    finally:
+        os.remove(path)
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /broadcast <nội dung>: gửi tới mọi người dùng chưa chặn bot; không có nội dung thì xem tiến độ
+    if not is_admin(update):
+        return
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ''
+    if active_broadcast is not None:
+        if text:
+            await update.message.reply_text(f"Đang gửi tin hàng loạt #{active_broadcast.id}, dừng bằng /broadcast_cancel.")
         else:
-            message = f"❌ Giao dịch rút tiền {amount} VND thất bại do số dư không đủ!"
-    elif action == "chuyển khoản":
-        recipient_user_id = context.user_data.get('recipient_user_id')
-        if recipient_user_id:
-            recipient_data = read_user_data(recipient_user_id)
-            if recipient_data:
-                total_balance = bank_account_info['deposited_amount'] + (click_count * (bank_account_info['deposited_amount'] * 0.00005))
-                if amount <= total_balance:
-                    bank_account_info['deposited_amount'] -= amount
-                    with connect_db() as conn:
-                        cursor = conn.cursor()
-                        cursor.execute('UPDATE users SET deposited_amount = deposited_amount + ? WHERE user_id = ?', (amount, recipient_user_id))
-                        conn.commit()
-                    message = f"✅ Giao dịch chuyển khoản {amount} VND đến người dùng (ID: {recipient_user_id}) thành công!"
-                else:
-                    message = f"❌ Giao dịch chuyển khoản {amount} VND thất bại do số dư không đủ!"
-            else:
-                message = "❌ Người nhận không tồn tại."
+            await update.message.reply_text(active_broadcast.progress_message())
+        return
+    # Lượt gửi bị dừng do lỗi vẫn ở trạng thái 'running' trong DB: tiếp tục nó trước
+    row = await run_db(_fetch_running_broadcast)
+    if row is not None:
+        if text:
+            await update.message.reply_text(f"Gửi tin hàng loạt #{row[0]} đang dở dang, gửi /broadcast để tiếp tục "
+                                            "hoặc /broadcast_cancel để hủy.")
         else:
-            message = "❌ Không xác định được người nhận."
+            await update.message.reply_text(f"▶️ Tiếp tục gửi tin hàng loạt #{row[0]} từ sau người dùng {row[2]}.")
+            start_broadcast(row)
+        return
+    if not text:
+        await update.message.reply_text("Cách dùng: /broadcast <nội dung>")
+        return
 
-    await send_user_notification(user_chat_id, message)
-    context.user_data['pending_transaction'] = None
-    save_user_data(user_chat_id)
-    await update.callback_query.answer("Giao dịch đã được phê duyệt!")
+    total = await run_db(_count_broadcast_recipients)
+    broadcast_id = await run_db(_insert_broadcast, text, total, time.time())
+    logging.info(f"Bắt đầu gửi tin hàng loạt #{broadcast_id} tới {total} người dùng")
+    start_broadcast((broadcast_id, text, 0, total, 0, 0, 0, None))
 
-async def deny_transaction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    transaction = context.user_data.get('pending_transaction')
-    if transaction:
-        user_chat_id = transaction['user_chat_id']
-        action = transaction['action']
-        amount = transaction['amount']
-        message = f"❌ Giao dịch {action} tiền {amount} VND đã bị từ chối!"
-        await send_user_notification(user_chat_id, message)
-    context.user_data['pending_transaction'] = None
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update):
+        return
+    if active_broadcast is None:
+        row = await run_db(_fetch_running_broadcast)
+        if row is None:
+            await update.message.reply_text("Không có lượt gửi tin hàng loạt nào đang chạy.")
+            return
+        # Lượt gửi dở dang (bị dừng do lỗi): chỉ cần đánh dấu đã hủy trong DB
+        broadcast_id, _, last_user_id, _, sent, failed, blocked, _ = row
+        await run_db(_save_broadcast, (last_user_id, sent, failed, blocked, 'cancelled', time.time(), broadcast_id), [], time.time())
+        await update.message.reply_text(f"⏹ Đã hủy gửi tin hàng loạt #{broadcast_id}.")
+        return
+    active_broadcast.cancelled = True
+    await update.message.reply_text(f"⏹ Đang dừng gửi tin hàng loạt #{active_broadcast.id}...")
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.info("Lệnh /start đã được gọi.")
@@ -212,21 +1933,17 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         user_last_name = update.message.from_user.last_name
         full_name = f"{user_first_name} {user_last_name}" if user_last_name else user_first_name
 
-        # Khởi tạo cơ sở dữ liệu nếu chưa có
-        init_db()
-
         # Kiểm tra xem người dùng đã có dữ liệu trong database chưa
-        user_data = read_user_data(user_id)
-        if user_data is None:
-            bank_account_info.update({'account_number': '', 'bank_name': '', 'phone_number': ''})
-            save_user_data(user_id)
+        await get_user_state(user_id, create=True)
+        # Người dùng quay lại sau khi chặn bot thì lại nhận tin hàng loạt
+        await run_db(_unblock_user, user_id)
         
         # Tạo bàn phím menu
         reply_keyboard = [
             ['Click để tăng lãi suất'],
             ['Nạp tiền', 'Rút tiền'],
             ['Chuyển khoản', 'Kiểm tra số dư'],
-            ['Thông tin']
+            ['Lịch sử giao dịch', 'Thông tin']
         ]
         reply_markup = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True, one_time_keyboard=False)
 
@@ -237,14 +1954,10 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text("❌ Đã xảy ra lỗi! Vui lòng thử lại sau.")
 
 async def big_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global last_click_time
-
-    current_time = time.time()
-    if current_time - last_click_time < 1.5:
+    if not rate_limiter.check('big_button', update):
         await update.message.reply_text("Vui lòng chờ một chút trước khi nhấn lại!")
         return
 
-    last_click_time = current_time
     message = "📆 Click để cập nhật thu nhập!"
     keyboard = [[InlineKeyboardButton("Cập nhật thu nhập", callback_data='update_income')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -252,66 +1965,96 @@ async def big_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text(message, reply_markup=reply_markup)
 
 async def update_income_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global income_today, click_count, last_update_time
-    current_time = time.time()
-
-    if current_time - last_update_time < 2:
+    if not rate_limiter.check('update_income', update):
         await update.callback_query.answer("Vui lòng chờ một chút trước khi cập nhật!")
         return
 
     query = update.callback_query
     await query.answer("🤑 Cập nhật thành công!")
 
-    deposited_amount = bank_account_info['deposited_amount']
+    state = await get_user_state(update.effective_user.id, create=True)
+    deposited_amount = state.deposited_amount
     interest_per_click = deposited_amount * 0.00005
 
-    income_today += interest_per_click
-    click_count += 1
-    last_update_time = current_time
+    state.income_today += interest_per_click
+    state.click_count += 1
+    click_accumulator.add(state.user_id, interest_per_click)
 
-    progress = (click_count / target_clicks) * 100
+    progress = (state.click_count / target_clicks) * 100
 
     message = (
-        f"📆 Số lần nhấn hôm nay: {click_count} / {target_clicks}\n"
+        f"📆 Số lần nhấn hôm nay: {state.click_count} / {target_clicks}\n"
         f"♻️ Tiến độ: {progress:.2f} %\n"
         f"💵 Lãi suất của 1 lần click: {interest_per_click:.2f} VND\n"
         f"💰 Số tiền đã nạp vào: {deposited_amount} VND\n"
-        f"💰 Thu nhập hôm nay: {income_today:.2f} VND\n"
+        f"💰 Thu nhập hôm nay: {state.income_today:.2f} VND\n"
     )
 
-    await query.edit_message_text(text=message, reply_markup=query.message.reply_markup)
+    # Nhấn liên tục chỉ tạo một lần sửa tin với nội dung mới nhất
+    outbound_queue.edit(query.message.chat_id, query.message.message_id, message, query.message.reply_markup)
 
 async def deposit_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Vui lòng nhập số tiền bạn muốn nạp vào:")
-    context.user_data['waiting_for_deposit'] = True
+    set_conversation(update.effective_user.id, 'deposit_amount')
 
 async def withdraw_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Vui lòng nhập số tiền bạn muốn rút:")
-    context.user_data['waiting_for_withdraw'] = True
+    set_conversation(update.effective_user.id, 'withdraw_amount')
 
 async def transfer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Vui lòng nhập ID người nhận:")
-    context.user_data['waiting_for_transfer'] = True
+    set_conversation(update.effective_user.id, 'transfer_recipient')
 
 async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    deposited_amount = bank_account_info['deposited_amount']
-    total_income = click_count * (deposited_amount * 0.00005)
-    total_balance = deposited_amount + total_income
+    deposited_amount, withdrawn_amount, total_balance = await read_balance(update.effective_user.id)
+    total_income = total_balance - deposited_amount
 
     balance_message = (
         f"💰 Số tiền đã nạp vào: {deposited_amount} VND\n"
         f"📈 Lãi suất từ số tiền đã nạp: {total_income:.2f} VND\n"
         f"💵 Tổng số dư khả dụng: {total_balance:.2f} VND\n"
-        f"💰 Số tiền đã rút: {bank_account_info['withdrawn_amount']} VND"
+        f"💰 Số tiền đã rút: {withdrawn_amount} VND"
     )
     await update.message.reply_text(balance_message)
 
+async def history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Phân trang theo khóa (created_at, id) trên chỉ mục (user_id, created_at)
+    query = update.callback_query
+    before = (float('inf'), 0)
+    if query:
+        await query.answer()
+        _, created_at, transaction_id = query.data.split(':')
+        before = (float(created_at), int(transaction_id))
+
+    rows = await run_db(_fetch_transactions, update.effective_user.id, before, TRANSACTION_PAGE_SIZE)
+    if not rows:
+        text = "📜 Không còn giao dịch nào."
+        reply_markup = None
+    else:
+        lines = ["📜 Lịch sử giao dịch:"]
+        for transaction_id, kind, amount, counterparty_id, created_at in rows:
+            when = time.strftime('%d/%m/%Y %H:%M', time.localtime(created_at))
+            counterparty = f" (ID: {counterparty_id})" if counterparty_id else ""
+            lines.append(f"{when} - {TRANSACTION_LABELS[kind]}{counterparty}: {amount:+,.2f} VND")
+        text = "\n".join(lines)
+        reply_markup = None
+        if len(rows) == TRANSACTION_PAGE_SIZE:
+            last = rows[-1]
+            keyboard = [[InlineKeyboardButton("Cũ hơn", callback_data=f"history:{last[4]!r}:{last[0]}")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+
+    if query:
+        await query.message.reply_text(text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
 async def show_account_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    state = await get_user_state(update.effective_user.id, create=True)
     account_info_message = (
         "📋 Thông tin tài khoản:\n"
-        f"Số tài khoản: {bank_account_info['account_number'] or 'Chưa cập nhật'}\n"
-        f"Tên ngân hàng: {bank_account_info['bank_name'] or 'Chưa cập nhật'}\n"
-        f"Số điện thoại: {bank_account_info['phone_number'] or 'Chưa cập nhật'}\n"
+        f"Số tài khoản: {state.account_number or 'Chưa cập nhật'}\n"
+        f"Tên ngân hàng: {state.bank_name or 'Chưa cập nhật'}\n"
+        f"Số điện thoại: {state.phone_number or 'Chưa cập nhật'}\n"
     )
 
     keyboard = [
@@ -323,152 +2066,541 @@ async def show_account_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     await update.message.reply_text(account_info_message, reply_markup=reply_markup)
 
+# Nút cập nhật -> (trường PII, lời nhắc, thông báo thành công)
+ACCOUNT_INFO_FIELDS = {
+    'update_account_number': ('account_number', "số tài khoản mới:", "✅ Số tài khoản đã được cập nhật thành công!"),
+    'update_bank_name': ('bank_name', "tên ngân hàng mới:", "✅ Tên ngân hàng đã được cập nhật thành công!"),
+    'update_phone_number': ('phone_number', "số điện thoại mới:", "✅ Số điện thoại đã được cập nhật thành công!"),
+}
+
 async def update_account_info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
 
-    context.user_data['waiting_for_account_info'] = True
-    context.user_data['update_type'] = query.data
-    prompt_message = "Vui lòng nhập "
-    if query.data == 'update_account_number':
-        prompt_message += "số tài khoản mới:"
-    elif query.data == 'update_bank_name':
-        prompt_message += "tên ngân hàng mới:"
-    elif query.data == 'update_phone_number':
-        prompt_message += "số điện thoại mới:"
-    
-    await query.message.reply_text(prompt_message)
+    set_conversation(update.effective_user.id, 'account_info', query.data)
+    await query.message.reply_text("Vui lòng nhập " + ACCOUNT_INFO_FIELDS[query.data][1])
+
+# Trạng thái hội thoại của mỗi người dùng: một đối tượng nhỏ trong OrderedDict theo thứ tự
+# cập nhật. Thời hạn cố định nên các mục hết hạn luôn nằm ở đầu và được dọn khi ghi.
+class Conversation:
+    __slots__ = ('state', 'data', 'expires_at')
+
+    def __init__(self, state: str, data, expires_at: float):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at
+
+conversations = OrderedDict()
+
+def set_conversation(user_id: int, state: str, data=None):
+    now = time.monotonic()
+    conversations.pop(user_id, None)
+    conversations[user_id] = Conversation(state, data, now + CONVERSATION_TIMEOUT)
+    while conversations:
+        oldest = next(iter(conversations.values()))
+        if oldest.expires_at > now and len(conversations) <= CONVERSATION_CACHE_SIZE:
+            break
+        conversations.popitem(last=False)
+
+def end_conversation(user_id: int):
+    conversations.pop(user_id, None)
+
+def _parse_amount(text: str):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+async def deposit_amount_step(update: Update, user_id: int, user_info: str, conversation: Conversation):
+    end_conversation(user_id)
+    amount = _parse_amount(update.message.text)
+    if amount is None:
+        await update.message.reply_text("Vui lòng nhập một số hợp lệ.")
+    elif amount <= 0:
+        await update.message.reply_text("Số tiền nạp phải lớn hơn 0.")
+    else:
+        await notify_admin(update, user_id, user_info, 'deposit', amount)
+
+async def withdraw_amount_step(update: Update, user_id: int, user_info: str, conversation: Conversation):
+    end_conversation(user_id)
+    amount = _parse_amount(update.message.text)
+    if amount is None:
+        await update.message.reply_text("Vui lòng nhập một số hợp lệ.")
+        return
+    if amount <= 0:
+        await update.message.reply_text("Số tiền rút phải lớn hơn 0.")
+        return
+
+    _, _, total_balance = await read_balance(user_id)
+
+    if amount > total_balance:
+        await update.message.reply_text("Số tiền rút không thể lớn hơn tổng số dư khả dụng.")
+        return
+
+    await notify_admin(update, user_id, user_info, 'withdraw', amount)
+
+async def transfer_recipient_step(update: Update, user_id: int, user_info: str, conversation: Conversation):
+    end_conversation(user_id)
+    text = update.message.text.strip()
+    if not text.isdigit():
+        await update.message.reply_text("Vui lòng nhập một ID người dùng hợp lệ.")
+        return
+
+    recipient_user_id = int(text)
+    recipient = await get_user_state(recipient_user_id)
+    if not recipient:
+        await update.message.reply_text("❌ Người nhận không tồn tại.")
+        return
+
+    recipient_info_message = (
+        "🧾 Thông tin người nhận:\n"
+        f"ID: {recipient_user_id}\n"
+        f"Số tài khoản: {recipient.account_number}\n"
+        f"Tên ngân hàng: {recipient.bank_name}\n"
+        f"Số điện thoại: {recipient.phone_number}\n"
+        f"Số tiền đã nạp: {recipient.deposited_amount} VND\n"
+        f"Số tiền đã rút: {recipient.withdrawn_amount} VND\n"
+    )
+    await update.message.reply_text(recipient_info_message)
+    await update.message.reply_text("Vui lòng nhập số tiền bạn muốn chuyển khoản:")
+    set_conversation(user_id, 'transfer_amount', recipient_user_id)
+
+async def transfer_amount_step(update: Update, user_id: int, user_info: str, conversation: Conversation):
+    # Nhập sai thì giữ nguyên bước này để người dùng nhập lại
+    amount = _parse_amount(update.message.text)
+    if amount is None:
+        await update.message.reply_text("Vui lòng nhập một số hợp lệ.")
+        return
+    if amount <= 0:
+        await update.message.reply_text("Số tiền chuyển khoản phải lớn hơn 0.")
+        return
+
+    end_conversation(user_id)
+    await notify_admin(update, user_id, user_info, 'transfer', amount, conversation.data)
+
+async def account_info_step(update: Update, user_id: int, user_info: str, conversation: Conversation):
+    end_conversation(user_id)
+    field, _, done_message = ACCOUNT_INFO_FIELDS[conversation.data]
+    state = await get_user_state(user_id, create=True)
+    state.set_pii(field, update.message.text)
+    await update.message.reply_text(done_message)
+
+# Nút menu -> handler; trạng thái hội thoại -> bước xử lý tin nhắn kế tiếp
+MENU_HANDLERS = {
+    'Click để tăng lãi suất': big_button_handler,
+    'Nạp tiền': deposit_handler,
+    'Rút tiền': withdraw_handler,
+    'Chuyển khoản': transfer_handler,
+    'Kiểm tra số dư': check_balance,
+    'Lịch sử giao dịch': history_handler,
+    'Thông tin': show_account_info,
+}
+
+CONVERSATION_STEPS = {
+    'deposit_amount': deposit_amount_step,
+    'withdraw_amount': withdraw_amount_step,
+    'transfer_recipient': transfer_recipient_step,
+    'transfer_amount': transfer_amount_step,
+    'account_info': account_info_step,
+}
 
 async def reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.message.from_user.id  
+    user_choice = update.message.text
+
+    menu_handler = MENU_HANDLERS.get(user_choice)
+    if menu_handler is not None:
+        await menu_handler(update, context)
+        return
+
+    user_id = update.message.from_user.id
+    conversation = conversations.get(user_id)
+    if conversation is None:
+        return
+    if conversation.expires_at <= time.monotonic():
+        end_conversation(user_id)
+        await update.message.reply_text("⌛ Yêu cầu đã hết hạn, vui lòng chọn lại từ menu.")
+        return
+
     user_info = f"{update.message.from_user.first_name} {update.message.from_user.last_name or ''}".strip()
-    user_chat_id = user_id  
+    await CONVERSATION_STEPS[conversation.state](update, user_id, user_info, conversation)
 
-    user_choice = update.message.text
+# Xử lý đồng thời update của các người dùng khác nhau, nhưng tuần tự trong cùng một
+# người dùng để trạng thái hội thoại không bị chạy đua. Lớp được
+# tạo khi dựng Application vì lớp cơ sở nằm trong telegram.ext.
+def per_user_update_processor(max_concurrent_updates: int):
+    from telegram.ext import BaseUpdateProcessor
 
-    if user_choice == 'Click để tăng lãi suất':
-        await big_button_handler(update, context)
-    elif user_choice == 'Nạp tiền':
-        await deposit_handler(update, context)
-    elif user_choice == 'Rút tiền':
-        await withdraw_handler(update, context)
-    elif user_choice == 'Chuyển khoản':
-        await transfer_handler(update, context)
-    elif user_choice == 'Kiểm tra số dư':
-        await check_balance(update, context)
-    elif user_choice == 'Thông tin':
-        await show_account_info(update, context)
-    elif context.user_data.get('waiting_for_deposit'):
-        try:
-            amount = float(update.message.text)
-            if amount <= 0:
-                await update.message.reply_text("Số tiền nạp phải lớn hơn 0.")
-                return
-            
-            await notify_admin(user_id, user_info, "nạp", amount, user_chat_id, context)
-        except ValueError:
-            await update.message.reply_text("Vui lòng nhập một số hợp lệ.")
-        finally:
-            context.user_data['waiting_for_deposit'] = False
-    elif context.user_data.get('waiting_for_withdraw'):
-        try:
-            amount = float(update.message.text)
-            if amount <= 0:
-                await update.message.reply_text("Số tiền rút phải lớn hơn 0.")
-                return
-            
-            deposited_amount = bank_account_info['deposited_amount']
-            total_income = click_count * (deposited_amount * 0.00005)
-            total_balance = deposited_amount + total_income
-            
-            if amount > total_balance:
-                await update.message.reply_text("Số tiền rút không thể lớn hơn tổng số dư khả dụng.")
+    class PerUserUpdateProcessor(BaseUpdateProcessor):
+        def __init__(self, max_concurrent_updates: int):
+            super().__init__(max_concurrent_updates)
+            # khóa -> [asyncio.Lock, số update đang giữ hoặc chờ khóa]
+            self._locks = {}
+            # Giới hạn số update chạy cùng lúc, chỉ tính các update đã tới lượt của người dùng
+            self._slots = asyncio.Semaphore(max_concurrent_updates)
+
+        @staticmethod
+        def _ordering_key(update: object):
+            if isinstance(update, Update):
+                if update.effective_user:
+                    return update.effective_user.id
+                if update.effective_chat:
+                    return update.effective_chat.id
+            return None
+
+        async def process_update(self, update: object, coroutine) -> None:
+            # Thay cho process_update của lớp cơ sở, vốn chiếm chỗ trong giới hạn chung trước khi
+            # gọi do_process_update: update chờ khóa của người dùng khi đó vẫn giữ chỗ, một người
+            # bấm liên tục có thể chiếm hết chỗ và làm mọi người dùng khác phải chờ.
+            # Bản lặp bị bỏ trước khi chạy handler nào, kể cả trước khi chờ khóa của người dùng
+            if isinstance(update, Update) and not update_deduper.check(update):
+                coroutine.close()
+                metrics.inc('bot_duplicate_updates_total')
                 return
-            
-            await notify_admin(user_id, user_info, "rút", amount, user_chat_id, context)
-        except ValueError:
-            await update.message.reply_text("Vui lòng nhập một số hợp lệ.")
-        finally:
-            context.user_data['waiting_for_withdraw'] = False
-    elif context.user_data.get('waiting_for_transfer'):
-        try:
-            recipient_user_id = int(update.message.text)
-            context.user_data['recipient_user_id'] = recipient_user_id
-            
-            recipient_data = read_user_data(recipient_user_id)
-            if recipient_data:
-                recipient_info_message = (
-                    "🧾 Thông tin người nhận:\n"
-                    f"ID: {recipient_user_id}\n"
-                    f"Số tài khoản: {recipient_data['Account Number']}\n"
-                    f"Tên ngân hàng: {recipient_data['Bank Name']}\n"
-                    f"Số điện thoại: {recipient_data['Phone Number']}\n"
-                    f"Số tiền đã nạp: {recipient_data['Deposited Amount']} VND\n"
-                    f"Số tiền đã rút: {recipient_data['Withdrawn Amount']} VND\n"
-                )
-                await update.message.reply_text(recipient_info_message)
-                await update.message.reply_text("Vui lòng nhập số tiền bạn muốn chuyển khoản:")
-            else:
-                await update.message.reply_text("❌ Người nhận không tồn tại.")
-        except ValueError:
-            await update.message.reply_text("Vui lòng nhập một ID người dùng hợp lệ.")
-        finally:
-            context.user_data['waiting_for_transfer'] = False
-    elif 'recipient_user_id' in context.user_data:
-        try:
-            amount = float(update.message.text)
-            if amount <= 0:
-                await update.message.reply_text("Số tiền chuyển khoản phải lớn hơn 0.")
+
+            key = self._ordering_key(update)
+            if key is None:
+                await self.do_process_update(update, coroutine)
                 return
-            
-            await notify_admin(user_id, user_info, "chuyển khoản", amount, user_chat_id, context)
-        except ValueError:
-            await update.message.reply_text("Vui lòng nhập một số hợp lệ.")
-
-async def update_account_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if context.user_data.get('waiting_for_account_info'):
-        update_type = context.user_data['update_type']
-        new_value = update.message.text
-        
-        if update_type == 'update_account_number':
-            bank_account_info['account_number'] = new_value
-            await update.message.reply_text("✅ Số tài khoản đã được cập nhật thành công!")
-        elif update_type == 'update_bank_name':
-            bank_account_info['bank_name'] = new_value
-            await update.message.reply_text("✅ Tên ngân hàng đã được cập nhật thành công!")
-        elif update_type == 'update_phone_number':
-            bank_account_info['phone_number'] = new_value
-            await update.message.reply_text("✅ Số điện thoại đã được cập nhật thành công!")
-
-        # Lưu dữ liệu tài khoản
-        user_id = update.message.from_user.id
-        save_user_data(user_id)
-        
-        context.user_data['waiting_for_account_info'] = False
+
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self.do_process_update(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+        async def do_process_update(self, update: object, coroutine) -> None:
+            async with self._slots:
+                await coroutine
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+    return PerUserUpdateProcessor(max_concurrent_updates)
 
 # Thêm hàm xử lý lỗi
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.error(f"Đã xảy ra lỗi: {context.error}")
-    await context.bot.send_message(chat_id=admin_user_id, text=f"❌ Một lỗi đã xảy ra trong bot: {str(context.error)}")
+    outbound_queue.send(admin_user_id, f"❌ Một lỗi đã xảy ra trong bot: {str(context.error)}", priority=PRIORITY_ADMIN)
+
+# Khởi tạo ứng dụng Telegram. request/get_updates_request cho phép thay lớp HTTP,
+# ví dụ bằng một Bot API giả khi đo tải cục bộ.
+def build_application(request=None, get_updates_request=None):
+    from telegram.ext import ApplicationBuilder, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+
+    builder = (
+        ApplicationBuilder()
+        .token(os.getenv("TELEGRAM_BOT_TOKEN"))
+        .concurrent_updates(per_user_update_processor(MAX_CONCURRENT_UPDATES))
+        .post_init(start_application)
+        .post_stop(stop_application)
+        .post_shutdown(shutdown_application)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    if get_updates_request is not None:
+        builder = builder.get_updates_request(get_updates_request)
+    app = builder.build()
+
+    # Đăng ký các handler
+    app.add_handler(CommandHandler("start", start_handler))
+    app.add_handler(CommandHandler("pending", pending_handler))
+    app.add_handler(CommandHandler("approve", approve_command))
+    app.add_handler(CommandHandler("deny", deny_command))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("export", export_command))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, reply_handler))
+    app.add_handler(CallbackQueryHandler(approve_transaction_handler, pattern='approve_transaction'))
+    app.add_handler(CallbackQueryHandler(deny_transaction_handler, pattern='deny_transaction'))
+    app.add_handler(CallbackQueryHandler(pending_handler, pattern='^pending_page:'))
+    app.add_handler(CallbackQueryHandler(page_resolve_handler, pattern='^(approve|deny)_page(:|$)'))
+    app.add_handler(CallbackQueryHandler(update_income_handler, pattern='update_income'))
+    app.add_handler(CallbackQueryHandler(history_handler, pattern='^history:'))
+    app.add_handler(CallbackQueryHandler(update_account_info_handler, pattern='^update_(account_number|bank_name|phone_number)$'))
+
+    # Đo số lần gọi và thời gian xử lý của từng handler
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+    # Đăng ký trình xử lý lỗi
+    app.add_error_handler(error_handler)
+
+    # Định kỳ ghi các trạng thái người dùng đã thay đổi xuống DB
+    app.job_queue.run_repeating(flush_user_states_job, interval=USER_FLUSH_INTERVAL, first=USER_FLUSH_INTERVAL)
+    # Chu kỳ lấy từ bộ gom click: max_delay là độ trễ tối đa trước khi một click được ghi
+    app.job_queue.run_repeating(flush_clicks_job, interval=click_accumulator.max_delay, first=click_accumulator.max_delay)
+    app.job_queue.run_repeating(flush_processed_updates_job, interval=DEDUPE_FLUSH_INTERVAL, first=DEDUPE_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(refresh_pending_count_job, interval=METRICS_REFRESH_INTERVAL, first=0)
+
+    # Tác vụ cuối ngày
+    if is_leader():
+        hour, minute = (int(part) for part in DAILY_RESET_TIME.split(':'))
+        app.job_queue.run_daily(daily_accrual_job, time=datetime.time(hour, minute, tzinfo=BOT_TIMEZONE))
+    return app
+
+# Chế độ nhiều tiến trình. Khóa định tuyến giống PerUserUpdateProcessor: người gửi, không có
+# thì chat.
+def update_routing_key(payload: dict) -> int:
+    for key, value in payload.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user')
+        if sender:
+            return sender['id']
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+# Chạy ở tiến trình nhận update: mỗi tiến trình xử lý có một hàng đợi vào; một luồng chuyển
+# tiếp các tin nhắn giữa các tiến trình (số dư sau khi duyệt, đặt lại cuối ngày, ...).
+class ShardRouter:
+    # request_factory/setup/on_message cho phép benchmark dùng Bot API giả và theo dõi tiến độ;
+    # on_failure được gọi (từ luồng theo dõi) khi một tiến trình xử lý chết ngay lúc khởi động
+    def __init__(self, count: int, request_factory=None, setup=None, on_message=None, on_failure=None):
+        import multiprocessing
+
+        self._context = multiprocessing.get_context('spawn')
+        self.count = count
+        self.on_message = on_message
+        self.on_failure = on_failure
+        self.failure = None
+        self.control = self._context.Queue()
+        self.inbound = [self._context.Queue() for _ in range(count)]
+        self._worker_args = (request_factory, setup)
+        self.processes = [self._new_process(index) for index in range(count)]
+        self._started_at = [0.0] * count
+        self._stopping = threading.Event()
+        self._forwarder = threading.Thread(target=self._forward_control, name='shard-control', daemon=True)
+        self._watcher = threading.Thread(target=self._watch_workers, name='shard-watch', daemon=True)
+
+    def _new_process(self, index: int):
+        return self._context.Process(target=run_worker, args=(index, self.count, self.inbound[index], self.control,
+                                                              *self._worker_args),
+                                     name=f'bot-worker-{index}', daemon=True)
 
-# Khởi tạo cơ sở dữ liệu
-init_db()
+    def _start_process(self, index: int):
+        self._started_at[index] = time.monotonic()
+        self.processes[index].start()
 
-# Khởi tạo ứng dụng Telegram
-application = ApplicationBuilder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
+    def start(self):
+        for index in range(self.count):
+            self._start_process(index)
+        self._forwarder.start()
+        self._watcher.start()
 
-# Đăng ký các handler
-application.add_handler(CommandHandler("start", start_handler))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, reply_handler))
-application.add_handler(CallbackQueryHandler(approve_transaction_handler, pattern='approve_transaction'))
-application.add_handler(CallbackQueryHandler(deny_transaction_handler, pattern='deny_transaction'))
-application.add_handler(CallbackQueryHandler(update_income_handler, pattern='update_income'))
-application.add_handler(CallbackQueryHandler(update_account_info_handler))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, update_account_info))
+    def route(self, payload: dict):
+        if self.failure is not None:
+            raise RuntimeError(self.failure)
+        self.inbound[update_routing_key(payload) % self.count].put(('update', payload))
 
-# Đăng ký trình xử lý lỗi
-application.add_error_handler(error_handler)
+    def _watch_workers(self):
+        while not self._stopping.wait(1.0):
+            for index, process in enumerate(self.processes):
+                if process.exitcode is None:
+                    continue
+                uptime = time.monotonic() - self._started_at[index]
+                if uptime < WORKER_RESTART_MIN_UPTIME:
+                    self.failure = f"{process.name} thoát với mã {process.exitcode} sau {uptime:.1f} giây"
+                    logging.error(f"{self.failure}, dừng bot")
+                    if self.on_failure is not None:
+                        self.on_failure()
+                    return
+                # Tiến trình chết có thể còn giữ khóa đọc của hàng đợi cũ: tiến trình thay thế dùng
+                # hàng đợi mới, các update còn nằm trong hàng đợi cũ bị bỏ
+                logging.error(f"{process.name} thoát với mã {process.exitcode} sau {uptime:.0f} giây, "
+                              f"khởi động lại (bỏ các update đang chờ của nó)")
+                stale = self.inbound[index]
+                self.inbound[index] = self._context.Queue()
+                # Không close(): route() ở luồng khác có thể vẫn đang đưa vào hàng đợi cũ
+                stale.cancel_join_thread()
+                self.processes[index] = self._new_process(index)
+                self._start_process(index)
 
-# Chạy bot
+    def _forward_control(self):
+        while True:
+            item = self.control.get()
+            if item is None:
+                return
+            sender, target, message = item
+            if target == 'intake':
+                if self.on_message is not None:
+                    self.on_message(sender, message)
+            elif target == 'others':
+                for index, inbound in enumerate(self.inbound):
+                    if index != sender:
+                        inbound.put(message)
+            else:
+                self.inbound[target].put(message)
+
+    def stop(self, timeout: float = 30.0):
+        # Mỗi tiến trình xử lý hết update đã nhận, ghi trạng thái xuống DB rồi thoát
+        self._stopping.set()
+        self._watcher.join()
+        for inbound in self.inbound:
+            inbound.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning(f"{process.name} không dừng sau {timeout} giây, buộc dừng")
+                process.terminate()
+        self.control.put(None)
+        self._forwarder.join()
+
+def _read_inbound(inbound, loop, handle_batch):
+    # Luồng đọc hàng đợi vào của tiến trình xử lý; gom nhiều tin cho một lần đánh thức event loop
+    import queue
+
+    while True:
+        batch = [inbound.get()]
+        while len(batch) < 256:
+            try:
+                batch.append(inbound.get_nowait())
+            except queue.Empty:
+                break
+        loop.call_soon_threadsafe(handle_batch, batch)
+        if None in batch:
+            return
+
+async def _worker_main(inbound, request_factory, setup):
+    request = request_factory() if request_factory is not None else None
+    app = build_application(request=request)
+    if setup is not None:
+        setup(app)
+    stopped = asyncio.Event()
+
+    def handle_batch(batch: list):
+        for message in batch:
+            if message is None:
+                stopped.set()
+            elif message[0] == 'update':
+                app.update_queue.put_nowait(Update.de_json(message[1], app.bot))
+            elif message[0] == 'balance':
+                apply_cached_balance(message[1], message[2])
+            elif message[0] == 'daily_reset':
+                reset_cached_counters()
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    reader = threading.Thread(target=_read_inbound, args=(inbound, asyncio.get_running_loop(), handle_batch),
+                              name='shard-inbound', daemon=True)
+    reader.start()
+    await stopped.wait()
+    # stop() xử lý nốt các update đã nằm trong update_queue
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+def run_worker(index: int, count: int, inbound, control, request_factory=None, setup=None):
+    global SHARD_INDEX, SHARD_COUNT, shard_control, METRICS_PORT
+    import signal
+
+    # Ctrl+C tới cả nhóm tiến trình; tiến trình xử lý chỉ dừng khi tiến trình nhận update báo
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    SHARD_INDEX, SHARD_COUNT, shard_control = index, count, control
+    if METRICS_PORT:
+        METRICS_PORT += index
+    # Giới hạn gửi tin toàn bot được chia đều cho các tiến trình
+    rate = SEND_GLOBAL_RATE / count
+    outbound_limiter.limits['send_global'] = (max(1.0, rate), rate, 'chat')
+    asyncio.run(_worker_main(inbound, request_factory, setup))
+
+async def run_intake(count: int):
+    from telegram import Bot
+    from telegram.ext import Updater
+    import signal
+
+    migrate_db()
+    # Tạo (nếu cần) khóa mã hóa trước khi các tiến trình xử lý khởi động và cùng đọc nó
+    get_cipher_suite()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    router = ShardRouter(count, on_failure=lambda: loop.call_soon_threadsafe(stop.set))
+    router.start()
+    logging.info(f"Đã khởi động {count} tiến trình xử lý")
+
+    update_queue = asyncio.Queue()
+    updater = Updater(bot=Bot(os.getenv("TELEGRAM_BOT_TOKEN")), update_queue=update_queue)
+    await updater.initialize()
+    if WEBHOOK_URL:
+        await updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        await updater.start_polling()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def forward():
+        while True:
+            update = await update_queue.get()
+            router.route(update.to_dict())
+
+    forwarder = loop.create_task(forward())
+    await stop.wait()
+    await updater.stop()
+    await updater.shutdown()
+    while not update_queue.empty() and router.failure is None:
+        await asyncio.sleep(0.05)
+    forwarder.cancel()
+    await asyncio.to_thread(router.stop)
+    if router.failure is not None:
+        raise SystemExit(router.failure)
+
+def export_cli(argv: list):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='bot.py export', description='Xuất một bảng ra file nén gzip')
+    parser.add_argument('table', choices=EXPORT_TABLES)
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--output', help='mặc định: <bảng>.<định dạng>.gz trong thư mục hiện tại')
+    args = parser.parse_args(argv)
+
+    migrate_db()
+    path = args.output or f"{args.table}.{args.format}.gz"
+    started = time.perf_counter()
+    count = export_table(args.table, args.format, path)
+    print(f"{count} hàng -> {path} ({time.perf_counter() - started:.1f}s)")
+
+# Chạy bot. Application chỉ được dựng ở đây; lược đồ DB được nâng cấp trong post_init.
+#   python bot.py                          chạy bot
+#   WORKERS=4 python bot.py                chạy bot với 4 tiến trình xử lý
+#   python bot.py export users --format jsonl --output users.jsonl.gz
 if __name__ == "__main__":
-    application.run_polling()
+    if sys.argv[1:2] == ['export']:
+        export_cli(sys.argv[2:])
+        sys.exit()
+
+    if WORKERS > 1:
+        asyncio.run(run_intake(WORKERS))
+        sys.exit()
+
+    application = build_application()
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        application.run_polling()